@@ -5,6 +5,9 @@ DARK_COLOR = "#823232"
 DARK_NEUTRAL = "#323232"
 LIGHT_NEUTRAL = "#CFCFCF"
 DEFAULT_OPACITY = 0.95
+FOCUS_OPACITY = False  # dim unfocused windows by UNFOCUSED_DIM
+FOCUSED_OPACITY = 1.0  # of the focused window when FOCUS_OPACITY is set
+UNFOCUSED_DIM = 0.1
 # {{{
 # Copyright (c) 2010 Aldo Cortesi
 # Copyright (c) 2010, 2014 dequis
@@ -33,18 +36,60 @@ DEFAULT_OPACITY = 0.95
 # SOFTWARE.
 # }}}
 # imports {{{
+import time
+
+_startup_clock = time.perf_counter()
+import abc
+import asyncio
+import contextlib
+import ctypes
+import functools
+import html
+import inspect
+import json
+import logging
+import mmap
 import os
+import queue
 import re
-from socket import gethostname
+import select
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import weakref
+from array import array
+from collections import deque
+from concurrent.futures import Future
 from typing import List
-from libqtile.backend.base import Window  # noqa: F401
+from libqtile.backend.base import Window
 from libqtile.config import Key, Screen, Group, Drag, Click
 from libqtile.config import ScratchPad, DropDown, Match
 from libqtile.lazy import lazy
-from libqtile import layout, bar, widget, hook
-from libqtile import extension
+from libqtile import layout, bar, widget, hook, qtile
 from libqtile.log_utils import logger
+from libqtile.widget.graph import _Graph
 
+try:
+    from dbus_next import Message, MessageFlag, MessageType
+    from dbus_next.aio import MessageBus
+except ImportError:  # optional, the media keys fall back to playerctl
+    MessageBus = None
+
+startup_timings: dict[str, float] = {}
+
+
+def startup_phase(name):
+    """Account the time elapsed since the previous phase to name"""
+    global _startup_clock
+    now = time.perf_counter()
+    startup_timings[name] = startup_timings.get(name, 0.0) + now - _startup_clock
+    _startup_clock = now
+
+
+startup_phase("imports")
 # }}}
 MARGIN = 4
 APP_FILES = "thunar"
@@ -53,22 +98,769 @@ APP_TERM = "kitty"
 # set to False to run ./gen-keybinding-img, current keys are for French azerty
 USE_CUSTOM_KEYS = not os.environ.get("NO_CUSTOM_KEYS")
 WORK_MODE = os.path.exists(os.path.expanduser("~/liberty"))
+HOSTNAME = socket.gethostname()
 mod = "mod4"
+# Match index {{{
+
+
+class WindowProps:
+    """Snapshot of the window properties looked at by ``Match`` rules"""
+
+    __slots__ = ("wm_class", "wm_type", "name", "wid")
+
+    def __init__(self, wm_class=(), wm_type=None, name=None, wid=None):
+        self.wm_class = list(wm_class)
+        self.wm_type = wm_type
+        self.name = name
+        self.wid = wid
+
+    def get_wm_class(self):
+        return self.wm_class
+
+    def get_wm_type(self):
+        return self.wm_type
+
+    def get_wm_role(self):
+        return None
+
+    def get_pid(self):
+        return None
+
+    def match(self, match):
+        return match.compare(self)
+
+
+_INDEXED_PROPS = ("wm_class", "title", "wm_type")
+
+
+def _substrings(value):
+    """All the substrings of value (qtile "include"-matches plain strings)"""
+    return {value[i:j] for i in range(len(value) + 1) for j in range(i, len(value) + 1)}
+
+
+def _prop_values(props, prop):
+    if prop == "wm_class":
+        return props.wm_class
+    value = props.name if prop == "title" else props.wm_type
+    return () if value is None else (value,)
+
+
+class MatchIndex:
+    """Compiled lookup over a list of ``Match``, answering like a linear scan
+
+    Plain string rules are hashed, single regex rules are merged into one
+    alternation per property and the rest is checked one by one. Candidates
+    are confirmed with ``Match.compare`` on a property snapshot, in the
+    original order, so results stay those of the list.
+    """
+
+    def __init__(self, matches, values=None):
+        self.matches = list(matches)
+        self.values = values
+        self._exact: dict[str, dict] = {p: {} for p in _INDEXED_PROPS}
+        self._regex: dict[str, re.Pattern] = {}
+        self._slow: set[int] = set()
+        self.fields: set[str] = set()
+        alternatives: dict[str, list] = {p: [] for p in _INDEXED_PROPS}
+
+        for i, match in enumerate(self.matches):
+            rules = match._rules
+            if not set(rules) <= set(_INDEXED_PROPS):
+                self._slow.add(i)
+                continue
+            strings = [p for p, v in rules.items() if isinstance(v, str)]
+            if strings:
+                for key in _substrings(rules[strings[0]]):
+                    self._exact[strings[0]].setdefault(key, set()).add(i)
+            elif (
+                len(rules) == 1
+                and not next(iter(rules.values())).groups
+                and not next(iter(rules.values())).flags & ~re.UNICODE
+            ):
+                prop, pattern = next(iter(rules.items()))
+                alternatives[prop].append("(?P<r%d>%s)" % (i, pattern.pattern))
+            else:
+                self._slow.add(i)
+                continue
+            self.fields.update(rules)
+
+        for prop, table in self._exact.items():
+            for key, hits in table.items():
+                table[key] = tuple(sorted(hits))
+        for prop, patterns in alternatives.items():
+            if patterns:
+                self._regex[prop] = re.compile("|".join(patterns))
+
+    def snapshot(self, window):
+        """Fetch the properties needed by the indexed rules, once"""
+        if isinstance(window, WindowProps):
+            return window
+        return WindowProps(
+            window.get_wm_class() or (),
+            window.get_wm_type() if "wm_type" in self.fields else None,
+            window.name if "title" in self.fields else None,
+            window.wid,
+        )
+
+    def find(self, window, props=None):
+        """Position of the first rule matching window, None if none does"""
+        if props is None:
+            props = self.snapshot(window)
+        candidates = set(self._slow)
+        for prop, table in self._exact.items():
+            if table:
+                for value in _prop_values(props, prop):
+                    candidates.update(table.get(value, ()))
+        for prop, regex in self._regex.items():
+            for value in _prop_values(props, prop):
+                found = regex.match(value)
+                if found:
+                    candidates.add(int(found.lastgroup[1:]))
+        for i in sorted(candidates):
+            if (window if i in self._slow else props).match(self.matches[i]):
+                return i
+        return None
+
+    def depends_only_on(self, *fields):
+        """True if the rules can be decided from those properties alone"""
+        return not self._slow and self.fields <= set(fields)
+
+    def matches_window(self, window, props=None):
+        return self.find(window, props) is not None
+
+    def value(self, window, props=None, default=None):
+        """Value associated to the first matching rule"""
+        i = self.find(window, props)
+        return default if i is None else self.values[i]
+
+
+# }}}
+# Instrumentation {{{
+LATENCY_SAMPLES = 256  # recent durations kept per function
+SHOW_LATENCY = False  # bar widget showing the slowest handler
+
+
+class SampleRing:
+    """Fixed size history of samples, newest last"""
+
+    def __init__(self, size, value=0.0):
+        self.data = array("d", [value]) * size
+        self.head = 0
+
+    def push(self, value):
+        self.head = (self.head + 1) % len(self.data)
+        self.data[self.head] = value
+
+    def fill(self, value):
+        self.data = array("d", [value]) * len(self.data)
+
+    def resize(self, size):
+        if size > len(self.data):
+            newest_first = self.latest(len(self.data))
+            self.data = array("d", [newest_first[-1]]) * size
+            self.head = len(newest_first) - 1
+            self.data[: self.head + 1] = array("d", reversed(newest_first))
+
+    def latest(self, count):
+        """The count newest samples, newest first (like _Graph.values)"""
+        head = self.head + 1
+        ordered = self.data[head:] + self.data[:head]
+        return ordered[::-1][:count].tolist()
+
+
+class LatencyStats:
+    """Call count, log2 histogram and recent durations of a function, in µs
+
+    histogram[i] counts the calls shorter than 2**i µs, the last bucket is open.
+    """
+
+    buckets = 16
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.histogram = array("L", [0]) * self.buckets
+        self.recent = SampleRing(LATENCY_SAMPLES)
+
+    def record(self, elapsed):
+        micros = elapsed * 1e6
+        self.count += 1
+        self.total += micros
+        self.histogram[min(int(micros).bit_length(), self.buckets - 1)] += 1
+        self.recent.push(micros)
+
+    def percentile(self, q):
+        samples = sorted(self.recent.latest(min(self.count, LATENCY_SAMPLES)))
+        return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else 0.0,
+            p50=self.percentile(0.5),
+            p95=self.percentile(0.95),
+            max=self.percentile(1.0),
+            histogram=self.histogram.tolist(),
+        )
+
+
+latency_stats: dict[str, LatencyStats] = {}
+
+
+def timed(func, name=None):
+    """Record the duration of every call to func in latency_stats
+
+    The wrapper is marked by its latency attribute, timing it again returns it
+    unchanged.
+    """
+    if hasattr(func, "latency"):
+        return func
+    stats = latency_stats.setdefault(name or func.__name__, LatencyStats())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.record(time.perf_counter() - start)
+
+    wrapper.latency = stats
+    return wrapper
+
+
+def instrument_hooks():
+    """Replace the hook handlers of this file by timed versions
+
+    Only plain functions: widgets unsubscribe their bound methods by identity
+    when they are finalized, which happens after a reload re-executes this file.
+    """
+    for event, handlers in hook.subscriptions.items():
+        for i, handler in enumerate(handlers):
+            if (
+                inspect.isfunction(handler)
+                and handler.__globals__ is globals()
+                and not asyncio.iscoroutinefunction(handler)
+            ):
+                handlers[i] = timed(handler, "%s:%s" % (event, handler.__name__))
+
+
+def latency_report():
+    """Latency summaries (µs) by function, slowest first. From a shell:
+    qtile cmd-obj -o cmd -f eval -a "sys.modules['config'].latency_report()"
+    """
+    summaries = {name: stats.summary() for name, stats in latency_stats.items()}
+    return dict(sorted(summaries.items(), key=lambda item: -item[1]["p95"]))
+
+
+def slowest_handler():
+    name, stats = max(latency_stats.items(), key=lambda item: item[1].percentile(0.95))
+    return "⏱ %s %.1fms" % (name, stats.percentile(0.95) / 1000)
+
+
+# }}}
+# Layout helpers {{{
+
+
+@contextlib.contextmanager
+def deferred_layout(groups):
+    """Collapse the layout_all calls made on groups into one per group, at exit"""
+    owned = [g for g in dict.fromkeys(groups) if g and "layout_all" not in vars(g)]
+    pending: dict = {}
+
+    def defer(group, warp=False):
+        pending[group] = pending.get(group, False) or warp
+
+    for group in owned:
+        group.layout_all = functools.partial(defer, group)
+    try:
+        yield
+    finally:
+        for group in owned:
+            del group.layout_all
+        for group, warp in pending.items():
+            group.layout_all(warp)
+
+
+placements: dict[int, tuple] = {}  # wid -> (place arguments, geometry they gave)
+placement_counts = [0, 0]  # place calls done, skipped
+
+
+def _placed_geometry(window):
+    return (
+        window.x,
+        window.y,
+        window.width,
+        window.height,
+        window.borderwidth,
+        getattr(window, "bordercolor", None),
+    )
+
+
+def place_if_changed(window, *args, **kwargs):
+    """window.place(), unless the window is still where the same call put it
+
+    Saves the configure, border painting and ConfigureNotify requests.
+    """
+    last = placements.get(window.wid)
+    if last is not None and last == ((args, kwargs), _placed_geometry(window)):
+        placement_counts[1] += 1
+        return
+    type(window).place(window, *args, **kwargs)
+    placement_counts[0] += 1
+    placements[window.wid] = ((args, kwargs), _placed_geometry(window))
+
+
+@hook.subscribe.client_killed
+def forget_placement(window):
+    placements.pop(window.wid, None)
+
+
+class CachedPlacement:
+    """Layout mixin placing the windows through place_if_changed"""
+
+    def __init__(self, **config):
+        config.setdefault("name", type(self).__name__.lower().replace("cached", ""))
+        super().__init__(**config)
+
+    def configure(self, client, screen_rect):
+        client.place = functools.partial(place_if_changed, client)
+        try:
+            super().configure(client, screen_rect)
+        finally:
+            del client.place
+
+
+class CachedMax(CachedPlacement, layout.Max):
+    pass
+
+
+class CachedBsp(CachedPlacement, layout.Bsp):
+    def layout(self, windows, screen_rect):
+        """Bsp.configure computes the geometry of the whole tree and walks it to
+        find the window's node, for every window: once per pass is enough"""
+        root = self.root
+        root.calc_geom(
+            screen_rect.x, screen_rect.y, screen_rect.width, screen_rect.height
+        )
+        nodes = {node.client: node for node in root if node.client is not None}
+        root.calc_geom = lambda *args: None
+        self.get_node = nodes.get
+        try:
+            super().layout(windows, screen_rect)
+        finally:
+            del root.calc_geom, self.get_node
+
+
+class CachedColumns(CachedPlacement, layout.Columns):
+    pass
+
+
+# }}}
+# Spawn helper {{{
+# runs in a small python started once, so that launching a command doesn't
+# fork the whole qtile process from its event loop
+SPAWNER_SOURCE = """
+import json, os, signal, socket, sys, time
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # let the kernel reap children
+sock = socket.socket(fileno=int(sys.argv[1]))
+null = os.open(os.devnull, os.O_RDWR)
+stdio = [(os.POSIX_SPAWN_DUP2, null, fd) for fd in (0, 1, 2)]
+env = dict(os.environ)
+for line in sock.makefile("r"):
+    request = json.loads(line)
+    env = request.get("env", env)
+    start = time.perf_counter()
+    try:
+        pid, error = os.posix_spawnp(
+            request["args"][0], request["args"], env, file_actions=stdio,
+            setsid=True, setsigdef=[signal.SIGCHLD],
+        ), None
+    except OSError as e:
+        pid, error = -1, str(e)
+    reply = dict(id=request["id"], pid=pid, error=error)
+    reply["elapsed"] = time.perf_counter() - start
+    sock.sendall(json.dumps(reply).encode() + b"\\n")
+"""
+
+
+class Spawner:
+    """Sends the commands to launch to the helper, qtile.spawn if it is gone"""
+
+    retry_delay = 30  # seconds before starting a new helper after a failure
+
+    def __init__(self):
+        self.process = None
+        self.sock = None
+        self.buffer = b""
+        self.pending: dict[int, tuple[str, float]] = {}
+        self.next_id = 0
+        self.env = None
+        self.failed_at = float("-inf")
+
+    def start(self):
+        ours, theirs = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, "-S", "-c", SPAWNER_SOURCE, str(theirs.fileno())],
+                pass_fds=[theirs.fileno()],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+        except OSError:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        ours.setblocking(False)
+        self.sock = ours
+        self.env = None
+        asyncio.get_running_loop().add_reader(ours.fileno(), self._on_reply)
+        logger.debug("spawn helper started, pid %d", self.process.pid)
+
+    def stop(self):
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        for name, _ in self.pending.values():
+            logger.warning("no answer from the spawn helper for %s", name)
+        self.pending.clear()
+        self.failed_at = time.monotonic()
+
+    def spawn(self, cmd, shell=False):
+        args = ["/bin/sh", "-c", cmd] if shell else shlex.split(cmd)
+        if self.sock is None and time.monotonic() - self.failed_at > self.retry_delay:
+            try:
+                self.start()
+            except OSError:
+                logger.exception("can't start the spawn helper")
+                self.failed_at = time.monotonic()
+        if self.sock is not None:
+            request = dict(id=self.next_id, args=args)
+            env = dict(os.environ)
+            env.pop("VIRTUAL_ENV", None)  # like qtile.spawn
+            if env != self.env:
+                request["env"] = self.env = env
+            try:
+                self.sock.sendall(json.dumps(request).encode() + b"\n")
+            except OSError:
+                logger.warning("spawn helper is gone, using qtile.spawn")
+                self.stop()
+            else:
+                self.pending[self.next_id] = (args[0], time.perf_counter())
+                self.next_id += 1
+                return
+        qtile.spawn(cmd, shell=shell)
+
+    def _on_reply(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            logger.warning("spawn helper exited")
+            self.stop()
+            return
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        for line in lines:
+            reply = json.loads(line)
+            name, sent = self.pending.pop(reply["id"])
+            if reply["error"]:
+                logger.error("couldn't spawn %s: %s", name, reply["error"])
+                continue
+            elapsed = time.perf_counter() - sent
+            latency_stats.setdefault("spawn:" + name, LatencyStats()).record(elapsed)
+            logger.debug(
+                "spawned %s (pid %d) in %.1fms, %.1fms in the helper",
+                name,
+                reply["pid"],
+                elapsed * 1000,
+                reply["elapsed"] * 1000,
+            )
+
+
+_previous_spawner = globals().get("spawner")
+if hasattr(_previous_spawner, "stop"):  # reloading, don't leave its helper running
+    _previous_spawner.stop()
+spawner = Spawner()
+
+
+@hook.subscribe.startup
+def start_spawner():
+    try:
+        spawner.start()
+    except OSError:
+        logger.exception("can't start the spawn helper, using qtile.spawn")
+
+
+# }}}
+# Media players {{{
+MPRIS_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_PATH = "/org/mpris/MediaPlayer2"
+MPRIS_PLAYER = "org.mpris.MediaPlayer2.Player"
+PLAYERCTL_COMMANDS = {
+    "PlayPause": "play-pause",
+    "Stop": "stop",
+    "Previous": "previous",
+    "Next": "next",
+}
+SHOW_NOW_PLAYING = True
+
+
+class MediaController:
+    """MPRIS client keeping one session bus connection for the session
+
+    Players are tracked from NameOwnerChanged, their state from their
+    PropertiesChanged signals. Commands go to the player which last started
+    playing, or through playerctl when there is no bus, no dbus-next or no
+    player known yet.
+    """
+
+    def __init__(self, bus_address=None):
+        self.bus_address = bus_address  # None for the session bus
+        self.bus = None
+        self.connecting = False
+        self.players: dict[str, dict] = {}  # unique bus name -> state
+        self.active = None  # unique bus name of the controlled player
+        self.listeners: list = []  # called with now_playing() on changes
+
+    def start(self):
+        if MessageBus is not None and self.bus is None and not self.connecting:
+            self.connecting = True
+            qtile.call_soon(asyncio.create_task, self.connect())
+
+    def stop(self):
+        if self.bus is not None:
+            self.bus.disconnect()
+            self.bus = None
+        self.players.clear()
+        self.active = None
+
+    async def connect(self):
+        try:
+            bus = await MessageBus(bus_address=self.bus_address).connect()
+            bus.add_message_handler(self._on_message)
+            for rule in (
+                "type='signal',member='NameOwnerChanged',arg0namespace='%s'"
+                % MPRIS_PREFIX.rstrip("."),
+                "type='signal',member='PropertiesChanged',path='%s'" % MPRIS_PATH,
+            ):
+                await self._call(bus, "AddMatch", "s", [rule])
+            names = (await self._call(bus, "ListNames"))[0]
+            self.bus = bus
+            for name in names:
+                if name.startswith(MPRIS_PREFIX):
+                    owner = (await self._call(bus, "GetNameOwner", "s", [name]))[0]
+                    await self._add(name, owner)
+        except Exception:
+            logger.exception("can't connect to the session bus, using playerctl")
+        finally:
+            self.connecting = False
+
+    @staticmethod
+    async def _call(bus, member, signature="", body=(), **message):
+        """Body of the reply to a method call, to the bus daemon by default"""
+        message.setdefault("destination", "org.freedesktop.DBus")
+        message.setdefault("path", "/org/freedesktop/DBus")
+        message.setdefault("interface", "org.freedesktop.DBus")
+        reply = await bus.call(
+            Message(member=member, signature=signature, body=list(body), **message)
+        )
+        if reply.message_type == MessageType.ERROR:
+            raise OSError("%s: %s" % (reply.error_name, reply.body))
+        return reply.body
+
+    async def _add(self, name, owner):
+        self.players[owner] = dict(name=name, status="Stopped", title="", artist="")
+        if self.active is None:
+            self.active = owner
+        try:
+            properties = await self._call(
+                self.bus,
+                "GetAll",
+                "s",
+                [MPRIS_PLAYER],
+                destination=owner,
+                path=MPRIS_PATH,
+                interface="org.freedesktop.DBus.Properties",
+            )
+        except OSError as error:
+            logger.warning("can't read the state of %s: %s", name, error)
+            return
+        if owner in self.players:  # it may have quit meanwhile
+            self._update(owner, properties[0])
+
+    def _remove(self, owner):
+        if self.players.pop(owner, None) is not None and owner == self.active:
+            playing = [o for o, p in self.players.items() if p["status"] == "Playing"]
+            self.active = (playing or list(self.players) or [None])[-1]
+            self._notify()
+
+    def _update(self, owner, properties):
+        player = self.players[owner]
+        if "PlaybackStatus" in properties:
+            player["status"] = properties["PlaybackStatus"].value
+            if player["status"] == "Playing":
+                self.active = owner
+        if "Metadata" in properties:
+            metadata = properties["Metadata"].value
+            title = metadata.get("xesam:title")
+            artist = metadata.get("xesam:artist")
+            player["title"] = title.value if title else ""
+            player["artist"] = ", ".join(artist.value) if artist else ""
+        if owner == self.active:
+            self._notify()
+
+    def _on_message(self, message):
+        if message.message_type != MessageType.SIGNAL:
+            return
+        if message.member == "NameOwnerChanged":
+            name, old, new = message.body
+            if name.startswith(MPRIS_PREFIX):
+                if old:
+                    self._remove(old)
+                if new:
+                    asyncio.create_task(self._add(name, new))
+        elif message.member == "PropertiesChanged" and message.sender in self.players:
+            interface, changed, _ = message.body
+            if interface == MPRIS_PLAYER:
+                self._update(message.sender, changed)
+
+    def _notify(self):
+        playing = self.now_playing()
+        for listener in self.listeners:
+            listener(playing)
+
+    def now_playing(self):
+        """State of the controlled player: name, status, title, artist"""
+        return self.players.get(self.active)
+
+    def command(self, method):
+        """Call a Player method (PlayPause, Next...) of the active player"""
+        if self.bus is not None and not self.bus.connected:
+            self.bus = None
+        if self.bus is None or self.active is None:
+            # not connected (yet), or no player known: playerctl looks again
+            self.start()
+            spawner.spawn("playerctl " + PLAYERCTL_COMMANDS[method])
+        else:
+            self.bus.send(
+                Message(
+                    destination=self.active,
+                    path=MPRIS_PATH,
+                    interface=MPRIS_PLAYER,
+                    member=method,
+                    flags=MessageFlag.NO_REPLY_EXPECTED,
+                )
+            )
+
+
+class NowPlaying(widget.TextBox):
+    """Title of the player the media keys control, updated by its signals"""
+
+    def _configure(self, qtile, bar):
+        super()._configure(qtile, bar)
+        if self.show not in media.listeners:
+            media.listeners.append(self.show)
+        media.start()
+        self.show(media.now_playing())
+
+    def show(self, playing):
+        text = ""
+        if playing and playing["title"] and playing["status"] != "Stopped":
+            icon = "⏵" if playing["status"] == "Playing" else "⏸"
+            title = " - ".join(filter(None, [playing["artist"], playing["title"]]))
+            text = html.escape("%s %s" % (icon, title))
+        if text != self.text:
+            self.update(text)
+
+    def finalize(self):
+        if self.show in media.listeners:
+            media.listeners.remove(self.show)
+        super().finalize()
+
+
+_previous_media = globals().get("media")
+if hasattr(_previous_media, "stop"):  # reloading
+    _previous_media.stop()
+media = MediaController()
+
+
+@hook.subscribe.startup
+def start_media():
+    media.start()
+
+
+# }}}
 # Action functions {{{
 
 
 @lazy.function
-def moveToNextScreen(qtile):
-    """Move active win to next screen"""
-    active_win = qtile.current_window
-    qtile.focus_screen(
-        (qtile.screens.index(qtile.current_screen) + 1) % len(qtile.screens)
+@timed
+def spawnCommand(qtile, cmd, shell=False):
+    """lazy.spawn going through the spawn helper"""
+    spawner.spawn(cmd, shell)
+
+
+@lazy.function
+@timed
+def mediaCommand(qtile, method):
+    """playerctl without the fork, see MediaController"""
+    media.command(method)
+
+
+@lazy.function
+@timed
+def showLauncher(qtile):
+    """Window switcher & application launcher, see Launcher"""
+    launcher.show()
+
+
+def next_screen(qtile, screen, step=1):
+    """Screen step places after screen, in qtile's order (Screen.index)"""
+    return qtile.screens[(screen.index + step) % len(qtile.screens)]
+
+
+def move_windows_to_screen(qtile, windows, screen, focus=True):
+    """Move windows to the group shown on screen in one batch
+
+    Every affected group is laid out once, after all the moves. With focus, the
+    screen gets the focus, on the current window if it was moved.
+    """
+    target = screen.group
+    active = qtile.current_window
+    moving = sorted(
+        (w for w in dict.fromkeys(windows) if w.group is not target),
+        key=lambda w: w is active,  # added last, so it's the target's current
     )
-    if active_win:
-        active_win.togroup(qtile.current_screen.group.name)
+    with deferred_layout([target, qtile.current_group] + [w.group for w in moving]):
+        for window in moving:
+            window.togroup(target.name)
+        if focus:
+            qtile.focus_screen(screen.index)
+    return moving
+
+
+@lazy.function
+@timed
+def moveToNextScreen(qtile, whole_group=False):
+    """Move active win, or all the windows of the group, to next screen"""
+    if whole_group:
+        windows = list(qtile.current_group.windows)
+    else:
+        windows = [qtile.current_window] if qtile.current_window else []
+    move_windows_to_screen(qtile, windows, next_screen(qtile, qtile.current_screen))
 
 
 @lazy.function
+@timed
 def toggle_maximize(qtile):
     """Toggle maximize state & fix Z-order"""
     window = qtile.current_window
@@ -76,73 +868,82 @@ def toggle_maximize(qtile):
     window.toggle_maximize()
 
 
+@timed
 def moveToGroup(qtile, direction, skip_empty=False, move_window=False):
     """Move to sibling groups"""
     old_window = qtile.current_window
-    cur_group = qtile.current_group
-
-    for _ in groups:  # just to limit it
-        cur_group = (
-            cur_group.get_next_group()
-            if direction > 0
-            else cur_group.get_previous_group()
-        )
-        if skip_empty and not len(cur_group.windows):
-            continue
-        if cur_group.screen and cur_group.screen != qtile.current_screen:
-            continue
-        break
-    if cur_group != qtile.current_group:
+    name = group_occupancy.sibling(
+        qtile.current_group.name, direction, skip_empty, qtile.current_screen.index
+    )
+    if name is not None and name != qtile.current_group.name:
         if hasattr(qtile.core, "set_desk_nr"):
-            qtile.core.set_desk_nr(qtile.groups.index(cur_group))
-        qtile.current_screen.set_group(cur_group)
-        if move_window:
-            old_window.togroup(qtile.current_group.name)
+            qtile.core.set_desk_nr(group_occupancy.index[name])
+        qtile.current_screen.set_group(qtile.groups_map[name])
+        if move_window and old_window:
+            old_window.togroup(name)
 
 
 @lazy.function
+@timed
 def raiseFloatingWindows(qtile):
-    """Raises floating windows to the top"""
-    for g in qtile.groups:
-        for window in g.windows:
-            if (
-                window.floating
-                and not window.fullscreen
-                and window.get_wm_type() != "desktop"
-            ):
+    """Raises floating windows of the visible groups to the top"""
+    for screen in qtile.screens:
+        group = screen.group
+        floats = [
+            w
+            for w in _floating_windows.values()
+            if w.group is group and not w.fullscreen and not w.minimized
+        ]
+        if floats:
+            # the most recently focused ends up on top
+            order = {w: i for i, w in enumerate(group.focus_history)}
+            for window in sorted(floats, key=lambda w: order.get(w, -1)):
                 window.bring_to_front()
 
 
 @lazy.function
+@timed
 def goToUrgent(qtile):
     """Switch to the next urgent group"""
     qtile.next_urgent()
 
 
+@lazy.function
+@timed
+def changeOpacity(qtile, method):
+    """up_opacity/down_opacity, the focus opacity then leaves the window as is"""
+    window = qtile.current_window
+    if window is not None:
+        _opacity_targets.pop(window.wid, None)
+        getattr(window, method)()
+
+
 # }}}
 keys = [  # {{{
     # Custom commands
     Key([mod, "shift"], "r", raiseFloatingWindows, desc="raise floating"),
     Key([mod], "o", moveToNextScreen, desc="move to next screen"),
+    Key(
+        [mod, "shift"],
+        "o",
+        moveToNextScreen(whole_group=True),
+        desc="move all windows to next screen",
+    ),
     Key([mod], "p", lazy.next_screen(), desc="go to next screen"),
-    Key([mod, "shift"], "p", lazy.spawn("passwordList.sh"), desc="Pick a password"),
-    Key([mod], "r", lazy.spawn("mymenu.sh"), desc="shortcuts menu"),
+    Key([mod, "shift"], "p", spawnCommand("passwordList.sh"), desc="Pick a password"),
+    Key([mod], "r", spawnCommand("mymenu.sh"), desc="shortcuts menu"),
     Key(
         [mod],
         "z",
-        lazy.spawn(
-            os.path.expanduser(
-                "rofi -show combi -combi-modi window,drun -modi combi -theme ~/.config/rofi/launchers/colorful/custom"
-            )
-        ),
+        showLauncher,
         desc="Custom menu",
     ),
-    Key([mod], "d", lazy.spawn("doNotDisturb"), desc="toggle notifications"),
-    Key([mod], "l", lazy.spawn("light-locker-command -l"), desc="lock screen"),
+    Key([mod], "d", spawnCommand("doNotDisturb"), desc="toggle notifications"),
+    Key([mod], "l", spawnCommand("light-locker-command -l"), desc="lock screen"),
     Key(
         [mod, "control"],
         "l",
-        lazy.spawn("xfce4-session-logout"),
+        spawnCommand("xfce4-session-logout"),
         desc="Shutdown popup",
     ),
     Key([mod], "u", goToUrgent, desc="Switch to urgent"),
@@ -150,8 +951,8 @@ keys = [  # {{{
     Key([mod], "f", lazy.window.toggle_fullscreen()),
     Key([mod], "n", lazy.window.toggle_minimize()),
     Key([mod, "shift"], "n", toggle_maximize),
-    Key([mod], "t", lazy.spawn(APP_FILES), desc="spawn file manager"),
-    Key([mod], "w", lazy.spawn(APP_WEB), desc="spawn web browser"),
+    Key([mod], "t", spawnCommand(APP_FILES), desc="spawn file manager"),
+    Key([mod], "w", spawnCommand(APP_WEB), desc="spawn web browser"),
     Key([mod], "b", lazy.hide_show_bar()),
     Key([mod], "Escape", lazy.screen.toggle_group()),
     # Switch between windows in current stack pane
@@ -209,8 +1010,15 @@ keys = [  # {{{
     Key([mod, "control"], "Down", lazy.layout.flip_down()),
     Key([mod, "control"], "Left", lazy.layout.flip_left()),
     Key([mod, "control"], "Right", lazy.layout.flip_right()),
-    Key(["control", mod, "shift"], "Up", lazy.window.up_opacity()),
-    Key(["control", mod, "shift"], "Down", lazy.window.down_opacity()),
+    Key(
+        ["control", mod, "shift"], "Up", changeOpacity("up_opacity"), desc="up opacity"
+    ),
+    Key(
+        ["control", mod, "shift"],
+        "Down",
+        changeOpacity("down_opacity"),
+        desc="down opacity",
+    ),
     # Switch window focus to other pane(s) of stack
     Key([mod], "Tab", lazy.layout.next()),
     # Swap panes of split stack
@@ -221,19 +1029,22 @@ keys = [  # {{{
     # multiple stack panes
     Key([mod], "BackSpace", lazy.layout.toggle_split()),
     Key([mod, "shift"], "BackSpace", lazy.layout.normalize()),
-    Key([mod], "Return", lazy.spawn(APP_TERM), desc="Spawn terminal"),
+    Key([mod], "Return", spawnCommand(APP_TERM), desc="Spawn terminal"),
     # Toggle between different layouts as defined below
     Key([mod], "space", lazy.next_layout()),
     Key([mod], "c", lazy.window.kill(), desc="Close window"),
     Key([mod, "control"], "r", lazy.restart()),
     # Audio controls (output volume managed by volumeicon)
-    Key([], "XF86AudioMicMute", lazy.spawn("toggleCapture"), desc="toggle microphone"),
+    Key(
+        [], "XF86AudioMicMute", spawnCommand("toggleCapture"), desc="toggle microphone"
+    ),
     # Media controls
-    Key([], "XF86AudioPlay", lazy.spawn("playerctl play-pause"), desc="toggle pause"),
-    Key([], "XF86AudioStop", lazy.spawn("playerctl stop"), desc="stop playback"),
-    Key([], "XF86AudioPrev", lazy.spawn("playerctl previous"), desc="previous track"),
-    Key([], "XF86AudioNext", lazy.spawn("playerctl next"), desc="next track"),
+    Key([], "XF86AudioPlay", mediaCommand("PlayPause"), desc="toggle pause"),
+    Key([], "XF86AudioStop", mediaCommand("Stop"), desc="stop playback"),
+    Key([], "XF86AudioPrev", mediaCommand("Previous"), desc="previous track"),
+    Key([], "XF86AudioNext", mediaCommand("Next"), desc="next track"),
 ]  # }}}
+startup_phase("keys")
 groups: list[Group] = []  # Groups definition {{{
 
 
@@ -327,9 +1138,6 @@ for i, group in enumerate(group_def):
         label="%s %s" % ((str(i + 1))[-1], group.icon) if group.key else group.icon,
         layout=group.layout or "bsp",
         spawn=group.spawn,
-        matches=[Match(wm_class=c) for c in group.wm_classes]
-        if group.wm_classes
-        else None,
     )
     groups.append(g)
 
@@ -351,12 +1159,655 @@ for i, group in enumerate(group_def):
         )
 
 
+def build_group_router(group_def):
+    """One MatchIndex routing the wm_classes of group_def to their group name
+
+    Replaces the per group ``matches``, which qtile checks group after group.
+    """
+    routes = [(c, g.name) for g in group_def for c in g.wm_classes or ()]
+    owners: dict[str, set] = {}
+    for cls, name in routes:
+        if isinstance(cls, str):
+            owners.setdefault(cls, set()).add(name)
+    for cls, name in routes:
+        if not isinstance(cls, str):
+            for other in owners:
+                if cls.match(other):
+                    owners[other].add(name)
+    for cls, names in owners.items():
+        if len(names) > 1:
+            logger.warning("%s is claimed by groups %s", cls, ", ".join(sorted(names)))
+    return MatchIndex(
+        [Match(wm_class=cls) for cls, _ in routes], [name for _, name in routes]
+    )
+
+
+group_router = build_group_router(group_def)
+
+
+class GroupOccupancy:
+    """Bitmasks of the non empty groups & of the groups shown on each screen"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.counts = [0] * len(self.names)
+        self.full = (1 << len(self.names)) - 1
+        self.occupied = 0
+        self.shown: dict[int, int] = {}  # screen index -> group bit
+        self._window_group: dict[int, int] = {}  # wid -> group index
+
+    def add(self, wid, name):
+        i = self.index.get(name)
+        if self._window_group.get(wid) == i:
+            return
+        self.remove(wid)
+        if i is not None:
+            self._window_group[wid] = i
+            self.counts[i] += 1
+            self.occupied |= 1 << i
+
+    def remove(self, wid):
+        i = self._window_group.pop(wid, None)
+        if i is not None:
+            self.counts[i] -= 1
+            if not self.counts[i]:
+                self.occupied &= ~(1 << i)
+
+    def show(self, screen_index, name):
+        i = self.index.get(name)
+        self.shown[screen_index] = 0 if i is None else 1 << i
+
+    def reset(self, qtile):
+        """Rebuild everything from qtile's state"""
+        self.__init__(self.names)
+        for group in qtile.groups:
+            for window in group.windows:
+                self.add(window.wid, group.name)
+        for screen in qtile.screens:
+            self.show(screen.index, screen.group.name)
+
+    def sibling(self, name, direction, skip_empty, screen_index):
+        """Closest group in direction, skipping those on other screens, cycling"""
+        i = self.index.get(name)
+        if i is None:
+            return None
+        mask = self.occupied if skip_empty else self.full
+        for index, bit in self.shown.items():
+            if index != screen_index:
+                mask &= ~bit
+        if direction > 0:
+            pick = (mask >> (i + 1) << (i + 1)) or mask
+            pick &= -pick
+        else:
+            pick = (mask & ((1 << i) - 1)) or mask
+        return self.names[pick.bit_length() - 1] if pick else None
+
+
+# kept across config reloads, which re-execute this file but re-add no window
+_previous_occupancy = globals().get("group_occupancy")
+group_occupancy = GroupOccupancy(g.name for g in groups)
+if getattr(_previous_occupancy, "names", None) == group_occupancy.names:
+    group_occupancy = _previous_occupancy
+
 LOG_FILE = (
     "/tmp/qtile-git.log"
     if os.path.exists("/tmp/qtile-git.log")
     else os.path.expanduser("~/.local/share/qtile/qtile.log")
 )
 
+# Log viewer {{{
+IN_MODIFY, IN_MOVE_SELF, IN_DELETE_SELF = 0x2, 0x800, 0x400
+
+
+class LogTail:
+    """Bounded line index over the end of a growing log file, read with mmap
+
+    Only the bytes appended since the previous update() are scanned, lines are
+    kept as (start, end, level) offsets in the mapping.
+    """
+
+    LEVELS = {b"DEBUG": 10, b"INFO": 20, b"WARNING": 30, b"ERROR": 40, b"CRITICAL": 50}
+    # "date time LEVEL ..." lines, the others (tracebacks) continue the previous
+    LINE = re.compile(rb"(?:\S+ \S+ (DEBUG|INFO|WARNING|ERROR|CRITICAL) )?[^\n]*\n")
+
+    def __init__(self, path, max_lines=20000):
+        self.path = path
+        self.lines = deque(maxlen=max_lines)
+        self.offset = 0
+        self.inode = None
+        self._fd = None
+        self._map = None
+
+    def _reopen(self, stat):
+        self.close()
+        self._fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        self.inode = stat.st_ino
+        self.lines.clear()
+        self.offset = 0
+        if stat.st_size:
+            self._map = mmap.mmap(self._fd, stat.st_size, access=mmap.ACCESS_READ)
+            # start max_lines before the end instead of scanning the whole file
+            pos = self._map.rfind(b"\n")
+            for _ in range(self.lines.maxlen):
+                if pos <= 0:
+                    break
+                pos = self._map.rfind(b"\n", 0, pos)
+            self.offset = pos + 1
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def update(self):
+        """Index the lines appended since the last call, True if there were any"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if (
+            stat.st_ino != self.inode
+            or stat.st_size < self.offset
+            or os.fstat(self._fd).st_size < len(self._map or b"")
+        ):
+            self._reopen(stat)  # rotated or truncated
+        if stat.st_size <= self.offset:
+            return False
+        if self._map is None or len(self._map) < stat.st_size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, stat.st_size, access=mmap.ACCESS_READ)
+        end = self._map.rfind(b"\n", self.offset)  # complete lines only
+        if end < 0:
+            return False
+        level = self.lines[-1][2] if self.lines else 20
+        for line in self.LINE.finditer(self._map, self.offset, end + 1):
+            if line.group(1):
+                level = self.LEVELS[line.group(1)]
+            self.lines.append((line.start(), line.end() - 1, level))
+        self.offset = end + 1
+        return True
+
+    def last(self, count, min_level=0, skip=0):
+        """The count lines at least min_level, skip lines before the end"""
+        found = []
+        for start, end, level in reversed(self.lines):
+            if level < min_level:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            found.append((level, self._map[start:end].decode(errors="replace")))
+            if len(found) == count:
+                break
+        found.reverse()
+        return found
+
+
+class LogViewer:
+    """Popup following a log file, woken up by inotify while it is shown
+
+    Wheel scrolls, left click cycles the minimum level, right click hides.
+    """
+
+    filters = (0, 20, 30, 40)
+    colors = {10: "#8A8A8A", 30: PRIMARY_COLOR, 40: "#FF6A6A", 50: "#FF6A6A"}
+
+    def __init__(self, path, x=0.1, y=0.62, width=0.8, height=0.36, **config):
+        self.tail = LogTail(path)
+        self.geometry = (x, y, width, height)
+        self.config = config
+        self.popup = None
+        self.shown = False
+        self.scroll = 0
+        self.min_level = 0
+        self._inotify = None
+        self._libc = None
+
+    def show(self):
+        from libqtile.popup import Popup
+
+        screen = qtile.current_screen
+        x, y, width, height = self.geometry
+        if self.popup is None:
+            self.popup = Popup(qtile, **self.config)
+            self.popup.win.process_button_click = self.on_click
+        self.popup.x = int(screen.x + x * screen.width)
+        self.popup.y = int(screen.y + y * screen.height)
+        self.popup.width = int(width * screen.width)
+        self.popup.height = int(height * screen.height)
+        self.scroll = 0
+        self.shown = True
+        self.tail.update()
+        self._watch()
+        self.popup.place()
+        self.popup.unhide()
+        self.draw()
+
+    def hide(self):
+        self.shown = False
+        self._unwatch()
+        if self.popup is not None:
+            self.popup.hide()
+
+    def draw(self):
+        popup = self.popup
+        rows = (popup.height - 2 * popup.vertical_padding) // int(popup.font_size * 1.3)
+        lines = self.tail.last(max(rows - 1, 1), self.min_level, self.scroll)
+        status = "%s  [%s]%s" % (
+            self.tail.path,
+            logging.getLevelName(self.min_level) if self.min_level else "ALL",
+            "  +%d" % self.scroll if self.scroll else "",
+        )
+        popup.text = "\n".join(
+            ['<span foreground="%s">%s</span>' % (SECONDARY_COLOR, html.escape(status))]
+            + [
+                '<span foreground="%s">%s</span>'
+                % (self.colors.get(level, LIGHT_NEUTRAL), html.escape(text))
+                for level, text in lines
+            ]
+        )
+        popup.clear()
+        popup.draw_text()
+        popup.draw()
+
+    def on_click(self, x, y, button):
+        if button == 3:
+            self.hide()
+            return
+        if button == 1:
+            self.min_level = self.filters[
+                (self.filters.index(self.min_level) + 1) % len(self.filters)
+            ]
+            self.scroll = 0
+        elif button == 4:
+            self.scroll += 3
+        elif button == 5:
+            self.scroll = max(0, self.scroll - 3)
+        self.draw()
+
+    def _watch(self):
+        if self._libc is None:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+        if self._inotify is None:
+            self._inotify = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if self._inotify < 0:
+                logger.warning("inotify: %s", os.strerror(ctypes.get_errno()))
+                self._inotify = None
+                return
+            asyncio.get_running_loop().add_reader(self._inotify, self._on_event)
+        self._libc.inotify_add_watch(
+            self._inotify,
+            self.tail.path.encode(),
+            IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF,
+        )
+
+    def _unwatch(self):
+        if self._inotify is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify)
+            os.close(self._inotify)
+            self._inotify = None
+
+    def _on_event(self):
+        with contextlib.suppress(BlockingIOError):
+            while os.read(self._inotify, 4096):
+                pass
+        inode = self.tail.inode
+        if not self.tail.update() and not os.path.exists(self.tail.path):
+            # rotated, wait for the new file
+            self._unwatch()
+            qtile.call_later(1, self._rewatch)
+            return
+        if self.tail.inode != inode:
+            self._unwatch()
+            self._watch()
+        if self.scroll == 0:
+            self.draw()
+
+    def _rewatch(self):
+        if not self.shown:
+            return
+        if not os.path.exists(self.tail.path):
+            qtile.call_later(1, self._rewatch)
+        else:
+            self.tail.update()
+            self._watch()
+            self.draw()
+
+
+log_viewer = LogViewer(
+    LOG_FILE,
+    font="monospace",
+    font_size=11,
+    wrap=False,
+    opacity=0.88,
+    background=DARK_NEUTRAL,
+    border=SECONDARY_COLOR,
+    border_width=2,
+    horizontal_padding=6,
+    vertical_padding=4,
+)
+# dropdowns handled by the config itself, see toggleDropDown
+native_dropdowns = {"qlog": log_viewer}
+# }}}
+# Launcher {{{
+LAUNCHER_CACHE = os.path.expanduser("~/.cache/qtile/launcher.json")
+DESKTOP_FIELD_CODES = re.compile(r"%[fFuUdDnNickvm]")
+
+
+def application_dirs():
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    data_dirs = os.environ.get("XDG_DATA_DIRS") or "/usr/local/share:/usr/share"
+    return [os.path.join(d, "applications") for d in [data_home] + data_dirs.split(":")]
+
+
+def read_desktop_entry(path):
+    """(name, command) of an application .desktop file, None if hidden"""
+    entry = {}
+    section = None
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("["):
+                    section = line
+                elif section == "[Desktop Entry]" and "=" in line:
+                    key, value = line.split("=", 1)
+                    entry.setdefault(key.strip(), value.strip())
+    except OSError:
+        return None
+    if (
+        entry.get("Type") != "Application"
+        or "Exec" not in entry
+        or entry.get("NoDisplay") == "true"
+        or entry.get("Hidden") == "true"
+    ):
+        return None
+    command = DESKTOP_FIELD_CODES.sub("", entry["Exec"]).replace("%%", "%").strip()
+    if entry.get("Terminal") == "true":
+        command = APP_TERM + " " + command
+    return entry.get("Name", os.path.basename(path)), command
+
+
+def _trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class LauncherIndex:
+    """Desktop applications cached on disk, searched through a trigram index
+
+    The cache is rebuilt when the mtime of one of the application directories
+    changed, short queries use an index of the words first letters.
+    """
+
+    def __init__(self):
+        self.mtimes: dict[str, float] = {}
+        self.entries: list[tuple[str, str]] = []
+        self.lowered: list[str] = []
+        self.trigrams: dict[str, set] = {}
+        self.prefixes: dict[str, set] = {}
+
+    def _dir_mtimes(self):
+        mtimes = {}
+        for root in application_dirs():
+            for path, _, _ in os.walk(root):
+                with contextlib.suppress(OSError):
+                    mtimes[path] = os.stat(path).st_mtime
+        return mtimes
+
+    def refresh(self):
+        """Reload the entries if the applications changed, True if they did"""
+        mtimes = self._dir_mtimes()
+        if mtimes == self.mtimes:
+            return False
+        cached = None
+        with contextlib.suppress(OSError, ValueError):
+            with open(LAUNCHER_CACHE) as f:
+                cached = json.load(f)
+        if cached and cached.get("mtimes") == mtimes:
+            entries = [tuple(entry) for entry in cached["entries"]]
+        else:
+            entries = self._scan(mtimes)
+            os.makedirs(os.path.dirname(LAUNCHER_CACHE), exist_ok=True)
+            with open(LAUNCHER_CACHE, "w") as f:
+                json.dump(dict(mtimes=mtimes, entries=entries), f)
+        self.mtimes = mtimes
+        self._build(entries)
+        return True
+
+    def _scan(self, mtimes):
+        found: dict[str, tuple[str, str]] = {}
+        for root in application_dirs():  # the first directories take precedence
+            for path in mtimes:
+                if path != root and not path.startswith(root + os.sep):
+                    continue
+                for name in os.listdir(path):
+                    desktop_id = os.path.relpath(os.path.join(path, name), root)
+                    desktop_id = desktop_id.replace(os.sep, "-")
+                    if not name.endswith(".desktop") or desktop_id in found:
+                        continue
+                    found[desktop_id] = read_desktop_entry(os.path.join(path, name))
+        return sorted(entry for entry in found.values() if entry)
+
+    def _build(self, entries):
+        self.entries = entries
+        self.lowered = [name.lower() for name, _ in entries]
+        self.trigrams = {}
+        self.prefixes = {}
+        for i, text in enumerate(self.lowered):
+            for trigram in _trigrams(text):
+                self.trigrams.setdefault(trigram, set()).add(i)
+            for word in text.split():
+                for prefix in (word[:1], word[:2]):
+                    self.prefixes.setdefault(prefix, set()).add(i)
+
+    def fuzzy(self, query, exclude=()):
+        """Positions of the entries containing the letters of query in order"""
+        pattern = re.compile(".*?".join(map(re.escape, query)))
+        return [
+            i
+            for i, text in enumerate(self.lowered)
+            if i not in exclude and pattern.search(text)
+        ]
+
+    def candidates(self, query):
+        """Positions of the entries which may contain query"""
+        if len(query) < 3:
+            return self.prefixes.get(query, set())
+        sets = sorted((self.trigrams.get(t, set()) for t in _trigrams(query)), key=len)
+        return set.intersection(*sets)
+
+
+def match_score(query, text):
+    """Lower is better, None if text (lower case) doesn't match query"""
+    if text.startswith(query):
+        return 0
+    position = text.find(query)
+    if position > 0:
+        return 1 if text[position - 1] == " " else 2
+    it = iter(text)
+    return 3 if all(char in it for char in query) else None
+
+
+class Launcher:
+    """Popup searching the open windows and the desktop applications
+
+    Type to filter, Up/Down or Tab to select, Return to run, Escape to close.
+    """
+
+    rows = 12
+
+    def __init__(self, **config):
+        self.config = config
+        self.index = LauncherIndex()
+        self.windows: dict[int, str] = {}  # wid -> name, kept by the hooks below
+        self.popup = None
+        self.query = ""
+        self.results: list = []
+        self.selected = 0
+        self._saved_focus = None
+        self._keys: dict[int, str] = {}
+
+    def show(self):
+        from libqtile.popup import Popup
+
+        start = time.perf_counter()
+        self.index.refresh()
+        if self.popup is None:
+            self.popup = Popup(qtile, **self.config)
+            self.popup.win.process_key_press = self.on_key
+            self.popup.win.process_button_click = self.on_click
+            for name in ("Escape", "Return", "BackSpace", "Up", "Down", "Tab"):
+                self._keys[qtile.core.keysym_from_name(name)] = name
+        screen = qtile.current_screen
+        self.popup.width = screen.width * 2 // 5
+        self.popup.height = int((self.rows + 1) * self.popup.font_size * 1.5)
+        self.popup.x = screen.x + (screen.width - self.popup.width) // 2
+        self.popup.y = screen.y + screen.height // 4
+        self.query = ""
+        self.search()
+        self.popup.place()
+        self.popup.unhide()
+        self._saved_focus = qtile.current_window
+        self.popup.win.focus(False)
+        self.draw()
+        logger.debug("launcher shown in %.1fms", (time.perf_counter() - start) * 1000)
+
+    def hide(self):
+        self.popup.hide()
+        if self._saved_focus is not None and self._saved_focus.group:
+            self._saved_focus.focus(False)
+        self._saved_focus = None
+
+    def search(self):
+        query = self.query.lower()
+        found = []
+        for wid, name in self.windows.items():
+            score = match_score(query, name.lower()) if query else 0
+            if score is not None:
+                found.append((score, len(name), "window", wid, name))
+        index = self.index
+        if query:
+            positions = index.candidates(query)
+            scores = [(match_score(query, index.lowered[i]), i) for i in positions]
+            if len(positions) < self.rows:  # fuzzy matches aren't indexed
+                scores += [(3, i) for i in index.fuzzy(query, positions)]
+        else:
+            scores = [(4, i) for i in range(min(len(index.entries), self.rows))]
+        for score, i in scores:
+            if score is not None:
+                name, command = index.entries[i]
+                found.append((score, len(name), "app", command, name))
+        found.sort(key=lambda result: (result[0], result[2] != "window", result[1]))
+        self.results = found[: self.rows]
+        self.selected = 0
+
+    def draw(self):
+        lines = [
+            '<span foreground="%s">&gt; %s</span>'
+            % (PRIMARY_COLOR, html.escape(self.query))
+        ]
+        for i, (_, _, kind, _, name) in enumerate(self.results):
+            if kind == "window":
+                window = qtile.windows_map.get(self.results[i][3])
+                group = window.group.name if window and window.group else "-"
+                name = "[%s] %s" % (group, name)
+            text = html.escape(name)
+            if i == self.selected:
+                text = '<span background="%s" foreground="#000">%s</span>' % (
+                    SECONDARY_COLOR,
+                    text,
+                )
+            lines.append(text)
+        self.popup.text = "\n".join(lines)
+        self.popup.clear()
+        self.popup.draw_text()
+        self.popup.draw()
+
+    def activate(self):
+        if not self.results:
+            return
+        _, _, kind, target, _ = self.results[self.selected]
+        self.hide()
+        if kind == "app":
+            spawner.spawn(target)
+            return
+        window = qtile.windows_map.get(target)
+        if window is not None and window.group is not None:
+            qtile.current_screen.set_group(window.group)
+            window.group.focus(window)
+
+    def on_key(self, keysym):
+        name = self._keys.get(keysym)
+        if name == "Escape":
+            self.hide()
+            return
+        if name == "Return":
+            self.activate()
+            return
+        if name in ("Down", "Tab"):
+            self.selected = min(self.selected + 1, max(len(self.results) - 1, 0))
+        elif name == "Up":
+            self.selected = max(self.selected - 1, 0)
+        elif name == "BackSpace":
+            self.query = self.query[:-1]
+            self.search()
+        elif 0x20 <= keysym <= 0xFF:
+            self.query += chr(keysym)
+            self.search()
+        else:
+            return
+        self.draw()
+
+    def on_click(self, x, y, button):
+        if button == 3:
+            self.hide()
+
+
+launcher = Launcher(
+    font="sans",
+    font_size=13,
+    wrap=False,
+    opacity=0.92,
+    background=DARK_NEUTRAL,
+    foreground=LIGHT_NEUTRAL,
+    border=PRIMARY_COLOR,
+    border_width=2,
+    horizontal_padding=8,
+    vertical_padding=6,
+)
+
+
+@hook.subscribe.client_managed
+def add_launcher_window(window):
+    if window.group is not None:
+        launcher.windows[window.wid] = window.name or ""
+
+
+@hook.subscribe.client_name_updated
+def rename_launcher_window(window):
+    if window.wid in launcher.windows:
+        launcher.windows[window.wid] = window.name or ""
+
+
+@hook.subscribe.client_killed
+def remove_launcher_window(window):
+    launcher.windows.pop(window.wid, None)
+
+
+@hook.subscribe.startup_complete
+def warm_launcher():
+    for window in qtile.windows_map.values():
+        if getattr(window, "group", None) is not None:
+            launcher.windows[window.wid] = window.name or ""
+    qtile.call_later(5, launcher.index.refresh)
+
+
+# }}}
 # Scratchpad
 groups.append(
     ScratchPad(
@@ -371,15 +1822,6 @@ groups.append(
                 kept_above=True,
                 width=0.80,
             ),
-            #             DropDown(
-            #                 "qlog",
-            #                 APP_TERM + " tail -f " + LOG_FILE,
-            #                 opacity=0.88,
-            #                 y=0.86,
-            #                 height=0.10,
-            #                 on_focus_lost_hide=False,
-            #                 width=0.80,
-            #             ),
         ],
     )
 )
@@ -399,44 +1841,196 @@ groups.append(
     )
 )
 
-groups.append(
-    ScratchPad(
-        "CPE",
-        [
-            DropDown(
-                "journal",
-                APP_TERM + " sstb journalctl -o cat -fxn -u jsapp",
-                opacity=0.88,
-                y=0.0,
-                height=0.499,
-                width=0.799,
-                on_focus_lost_hide=False,
-            ),
-            DropDown(
-                "term",
-                APP_TERM + " sstb",
-                opacity=0.88,
-                y=0.5,
-                height=0.499,
-                width=0.799,
-                on_focus_lost_hide=False,
-            ),
-            DropDown(
-                "vrcu",
-                APP_TERM + " vrcu",
-                opacity=0.88,
-                x=0.9,
-                height=1.0,
-                width=0.1,
-                on_focus_lost_hide=False,
-            ),
-        ],
-    )
+# scratchpads only created when first toggled, see add_deferred_scratchpad
+deferred_scratchpads: dict[str, ScratchPad] = {}
+deferred_scratchpads["CPE"] = ScratchPad(
+    "CPE",
+    [
+        DropDown(
+            "journal",
+            APP_TERM + " sstb journalctl -o cat -fxn -u jsapp",
+            opacity=0.88,
+            y=0.0,
+            height=0.499,
+            width=0.799,
+            on_focus_lost_hide=False,
+        ),
+        DropDown(
+            "term",
+            APP_TERM + " sstb",
+            opacity=0.88,
+            y=0.5,
+            height=0.499,
+            width=0.799,
+            on_focus_lost_hide=False,
+        ),
+        DropDown(
+            "vrcu",
+            APP_TERM + " vrcu",
+            opacity=0.88,
+            x=0.9,
+            height=1.0,
+            width=0.1,
+            on_focus_lost_hide=False,
+        ),
+    ],
 )
 
+# the deferred scratchpads already created, kept across config reloads: their
+# windows would be orphaned otherwise
+created_scratchpads: set[str] = globals().get("created_scratchpads", set())
+for sp_name in created_scratchpads:
+    if sp_name in deferred_scratchpads:
+        groups.append(deferred_scratchpads.pop(sp_name))
+
+
+def add_deferred_scratchpad(qtile, name):
+    """Create a ScratchPad group, doing what qtile.add_group does for the plain
+    groups it creates"""
+    from libqtile.scratchpad import ScratchPad as ScratchPadGroup
+
+    config = deferred_scratchpads.pop(name)
+    group = ScratchPadGroup(config.name, config.dropdowns, config.label, config.single)
+    group._configure(
+        [qtile.config.floating_layout], qtile.config.floating_layout, qtile
+    )
+    qtile.groups.append(group)
+    qtile.groups_map[name] = group
+    created_scratchpads.add(name)
+    hook.fire("addgroup", name)
+    hook.fire("changegroup")
+    qtile.update_desktops()
+    logger.info("created scratchpad %s", name)
+
+
+# Pre-warmed dropdowns {{{
+# set QTILE_PREWARM to spawn these hidden, at idle after startup, so that the
+# first toggle doesn't wait for the program to start
+PREWARM_DROPDOWNS = bool(os.environ.get("QTILE_PREWARM"))
+PREWARM_DELAY = 10  # seconds after startup
+PREWARM_STEP = 2  # seconds between two spawns
+PREWARM_BUDGET_MB = int(os.environ.get("QTILE_PREWARM_BUDGET_MB", 400))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+prewarmed_dropdowns = [("scratchpad", "term"), ("volume", "pavucontrol")]
+if WORK_MODE:
+    prewarmed_dropdowns += [("CPE", "journal"), ("CPE", "term"), ("CPE", "vrcu")]
+dropdown_last_used: dict[tuple[str, str], float] = {}
+_pending_toggles: dict[tuple[str, str], float] = {}  # cold toggles start time
+_prewarming: dict[tuple[str, str], float] = {}  # spawning -> configured opacity
+dropdown_configs = {
+    (scratchpad.name, dropdown.name): dropdown
+    for scratchpad in [*groups, *deferred_scratchpads.values()]
+    if isinstance(scratchpad, ScratchPad)
+    for dropdown in scratchpad.dropdowns
+}
+
+
+def _process_rss(pid):
+    """Resident memory of pid and its descendants, in bytes"""
+    pages = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open("/proc/%d/statm" % pid) as f:
+                pages += int(f.read().split()[1])
+            with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError, IndexError):
+            continue
+    return pages * PAGE_SIZE
+
 
+def prewarm_dropdowns(queue):
+    """Spawn the next dropdown of queue hidden, then schedule the following one"""
+    while queue:
+        key = group_name, name = queue.pop(0)
+        if key not in dropdown_configs:
+            logger.warning("no dropdown %s in %s to pre-warm", name, group_name)
+            continue
+        if group_name not in qtile.groups_map:
+            if group_name not in deferred_scratchpads:
+                continue
+            add_deferred_scratchpad(qtile, group_name)
+        group = qtile.groups_map[group_name]
+        if name in group.dropdowns or key in _prewarming or key in _pending_toggles:
+            continue
+        logger.debug("pre-warming dropdown %s/%s", group_name, name)
+        # a first toggle spawns it, transparent until hide_prewarmed_dropdown
+        _prewarming[key] = dropdown_configs[key].opacity
+        group.dropdown_reconfigure(name, opacity=0)
+        group.dropdown_toggle(name)
+        break
+    if queue:
+        qtile.call_later(PREWARM_STEP, prewarm_dropdowns, queue)
+    else:
+        qtile.call_later(PREWARM_DELAY, enforce_prewarm_budget)
+
+
+def enforce_prewarm_budget():
+    """Kill the least recently used hidden dropdowns until under budget"""
+    total = 0
+    hidden = []
+    for key in prewarmed_dropdowns:
+        group = qtile.groups_map.get(key[0])
+        dd = group.dropdowns.get(key[1]) if group else None
+        pid = dd.window.get_pid() if dd else None
+        if not pid:
+            continue
+        rss = _process_rss(pid)
+        total += rss
+        if not (dd.visible and dd.shown):
+            hidden.append((dropdown_last_used.get(key, 0.0), key, dd, rss))
+    hidden.sort(key=lambda h: h[0])
+    for _, key, dd, rss in hidden:
+        if total <= PREWARM_BUDGET_MB << 20:
+            break
+        logger.info("evicting dropdown %s/%s (%dMB)", *key, rss >> 20)
+        dd.window.kill()
+        total -= rss
+
+
+@hook.subscribe.startup_complete
+def schedule_prewarm():
+    if PREWARM_DROPDOWNS:
+        qtile.call_later(PREWARM_DELAY, prewarm_dropdowns, list(prewarmed_dropdowns))
+
+
+@hook.subscribe.client_managed
+def hide_prewarmed_dropdown(window):
+    for key, opacity in list(_prewarming.items()):
+        group = qtile.groups_map.get(key[0])
+        dd = group.dropdowns.get(key[1]) if group else None
+        if dd is not None and dd.window is window:
+            del _prewarming[key]
+            group.dropdown_reconfigure(key[1], opacity=opacity)
+            dd.hide()
+            window.opacity = opacity
+
+
+@hook.subscribe.client_managed
+def log_cold_dropdown_latency(window):
+    for key, start in list(_pending_toggles.items()):
+        dd = qtile.groups_map[key[0]].dropdowns.get(key[1])
+        if dd is not None and dd.window is window:
+            del _pending_toggles[key]
+            logger.debug(
+                "dropdown %s/%s visible after %.1fms (cold)",
+                *key,
+                (time.perf_counter() - start) * 1000,
+            )
+
+
+# }}}
+
+
+@timed
 def toggleDropDown(qtile, groupname, dropdowns):
-    dd = qtile.groups_map[groupname].dropdowns
+    start = time.perf_counter()
+    if groupname not in qtile.groups_map and groupname in deferred_scratchpads:
+        add_deferred_scratchpad(qtile, groupname)
+    group = qtile.groups_map[groupname]
+    dd = group.dropdowns
     try:
         first = dropdowns[0]
         displayed = dd[first].visible and dd[first].shown
@@ -445,17 +2039,38 @@ def toggleDropDown(qtile, groupname, dropdowns):
         displayed = False
 
     for name in dropdowns:
+        if name in native_dropdowns:
+            if displayed:
+                native_dropdowns[name].hide()
+            else:
+                native_dropdowns[name].show()
+            continue
         if displayed:
             try:
                 dd[name].hide()
             except KeyError:
                 pass
         else:
+            dropdown_last_used[groupname, name] = time.monotonic()
             try:
                 dd[name].show()
+                logger.debug(
+                    "dropdown %s/%s visible after %.1fms",
+                    groupname,
+                    name,
+                    (time.perf_counter() - start) * 1000,
+                )
                 # dd[name].window.bring_to_front()
             except KeyError:
-                qtile.groups_map[groupname].dropdown_toggle(name)
+                # cold start, or a pre-warmed one whose window isn't there yet:
+                # then it is shown as configured when it appears
+                if (groupname, name) in _prewarming:
+                    opacity = _prewarming.pop((groupname, name))
+                    group.dropdown_reconfigure(name, opacity=opacity)
+                _pending_toggles[groupname, name] = start
+                group.dropdown_toggle(name)
+    if displayed and PREWARM_DROPDOWNS:
+        qtile.call_soon(enforce_prewarm_budget)
     if first:
         dd[first].window.focus(warp=True)
 
@@ -476,7 +2091,7 @@ keys.extend(
             lazy.function(toggleDropDown, "volume", ["pavucontrol"]),
             desc="Toggle Mixer panel",
         ),
-        Key([mod], "x", lazy.spawn("toggleCapture"), desc="custom command"),
+        Key([mod], "x", spawnCommand("toggleCapture"), desc="custom command"),
     ]
 )
 
@@ -490,6 +2105,7 @@ if WORK_MODE:
             ),
         ]
     )
+startup_phase("groups")
 # }}}
 _layout_common_opts = dict(
     border_focus=PRIMARY_COLOR,
@@ -498,15 +2114,16 @@ _layout_common_opts = dict(
     border_width=2,
 )
 layouts = [
-    layout.Max(),
-    layout.Bsp(**_layout_common_opts),
-    layout.Columns(
+    CachedMax(),
+    CachedBsp(**_layout_common_opts),
+    CachedColumns(
         fair=True,
         border_focus_stack=SECONDARY_COLOR,
         border_normal_stack=DARK_COLOR,
-        **_layout_common_opts
+        **_layout_common_opts,
     ),
 ]
+startup_phase("layouts")
 # Screens : widgets {{{
 
 graph_width = 22
@@ -518,29 +2135,167 @@ widget_defaults = dict(
 
 
 # backlight detection {{{
-DEVICES_ROOT = "/sys/devices/pci0000:00"
-VALID_BL_DEVICES = [
-    "0000:00:02.0/drm/card0/card0-eDP-1/intel_backlight",
-    "0000:00:08.1/0000:05:00.0/backlight/amdgpu_bl0",
-    "0000:00:08.1/0000:05:00.0/backlight/amdgpu_bl1",
-    "0000:00:08.1/0000:05:00.0/backlight/amdgpu_bl2",
-]
+BACKLIGHT_ROOT = "/sys/class/backlight"
+BACKLIGHT_CACHE = os.path.expanduser("~/.cache/qtile/backlight.json")
+# preferred kinds of interfaces, see sysfs-class-backlight
+BACKLIGHT_TYPES = ("raw", "platform", "firmware")
 
 
-global BL_DEVICE_NAME
-BL_DEVICE_NAME = None
-for n in VALID_BL_DEVICES:
-    if os.path.exists(os.path.join(DEVICES_ROOT, n)):
-        BL_DEVICE_NAME = n
-        break
+def _read_sysfs(path, default=""):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def find_backlight():
+    """Name of the backlight device, scanned once per machine then cached
+
+    Not finding one isn't cached, the driver may be loaded later.
+    """
+    hardware = "%s:%s" % (
+        HOSTNAME,
+        _read_sysfs("/sys/class/dmi/id/product_name"),
+    )
+    try:
+        with open(BACKLIGHT_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    name = cache.get(hardware)
+    if name and os.path.exists(os.path.join(BACKLIGHT_ROOT, name)):
+        return name
+
+    try:
+        devices = sorted(os.listdir(BACKLIGHT_ROOT))
+    except OSError:
+        devices = []
+    kinds = {d: _read_sysfs(os.path.join(BACKLIGHT_ROOT, d, "type")) for d in devices}
+    devices.sort(
+        key=lambda d: BACKLIGHT_TYPES.index(kinds[d])
+        if kinds[d] in BACKLIGHT_TYPES
+        else 9
+    )
+    if not devices:
+        return None
+    cache[hardware] = name = devices[0]
+    try:
+        os.makedirs(os.path.dirname(BACKLIGHT_CACHE), exist_ok=True)
+        with open(BACKLIGHT_CACHE, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        logger.warning("Can't write %s", BACKLIGHT_CACHE)
+    return name
+
+
+class SysfsBacklight(widget.Backlight):
+    """Backlight widget refreshed by sysfs notifications, writing sysfs directly
+
+    Steps requested in a burst (key or wheel held) are merged into one write.
+    """
+
+    defaults = [
+        ("fallback_command", None, "Command used when sysfs isn't writable"),
+        ("batch_delay", 0.05, "Delay merging brightness steps, in seconds"),
+    ]
+
+    def __init__(self, **config):
+        config.setdefault("update_interval", None)
+        config.setdefault("change_command", None)
+        super().__init__(**config)
+        self.add_defaults(SysfsBacklight.defaults)
+        self._target = None
+        self._max_brightness = None
+        self._watched = None
+        self._poller = None
+        self._watch_tried = False
+
+    def timer_setup(self):
+        # called again by every update when polling
+        if not self._watch_tried:
+            self._watch_tried = True
+            try:
+                self._watch()
+            except OSError:
+                self._unwatch()
+                logger.warning(
+                    "No change notification for %s, polling", self.backlight_name
+                )
+                self.update_interval = 1
+        super().timer_setup()
+
+    def _watch(self):
+        # the backlight class calls sysfs_notify() on actual_brightness
+        path = os.path.join(os.path.dirname(self.brightness_file), "actual_brightness")
+        self._watched = open(path, "rb", buffering=0)
+        self._watched.read()
+        self._poller = select.epoll()
+        self._poller.register(self._watched, select.EPOLLPRI | select.EPOLLERR)
+        asyncio.get_running_loop().add_reader(self._poller.fileno(), self._on_change)
+
+    def _on_change(self):
+        self._poller.poll(0)
+        self._watched.seek(0)
+        self._watched.read()
+        self.tick()
+
+    def _unwatch(self):
+        if self._poller is not None:
+            asyncio.get_running_loop().remove_reader(self._poller.fileno())
+            self._poller.close()
+            self._poller = None
+        if self._watched is not None:
+            self._watched.close()
+            self._watched = None
+
+    def finalize(self):
+        self._unwatch()
+        self._watch_tried = False
+        super().finalize()
+
+    def _get_info(self):
+        if self._target is not None:
+            return self._target / 100
+        return super()._get_info()
+
+    def _change_backlight(self, value):
+        # called from an executor, _target is only handled on the loop
+        self.qtile.call_soon_threadsafe(self._queue_target, value)
+
+    def _queue_target(self, value):
+        pending = self._target is not None
+        self._target = value
+        if not pending:
+            self.timeout_add(self.batch_delay, self._write_target)
+
+    def _write_target(self):
+        value, self._target = self._target, None
+        if value is None:
+            return
+        if self._max_brightness is None:
+            self._max_brightness = self._load_file(self.max_brightness_file)
+        try:
+            with open(self.brightness_file, "w") as f:
+                f.write(str(round(self._max_brightness * value / 100)))
+        except PermissionError:
+            if not self.fallback_command:
+                logger.warning("Cannot write %s", self.brightness_file)
+                return
+            self.qtile.spawn(self.fallback_command.format(value))
+        if self._poller is None:
+            self.tick()
+
+
+BL_DEVICE_NAME = find_backlight()
 
 backlight_control = (
     [
-        widget.Backlight(
-            backlight_name=BL_DEVICE_NAME.rsplit("/", 1)[1],
+        SysfsBacklight(
+            backlight_name=BL_DEVICE_NAME,
             background=DARK_NEUTRAL,
             format="  {percent:2.0%}",
-            change_command="sudo brightnessctl s {0}%",
+            fallback_command="sudo brightnessctl s {0}%",
             step=2,
         ),
     ]
@@ -549,6 +2304,285 @@ backlight_control = (
 )
 # }}}
 
+media_control = (
+    [NowPlaying(max_chars=40, background=DARK_NEUTRAL)] if SHOW_NOW_PLAYING else []
+)
+latency_control = (
+    [
+        widget.GenPollText(
+            func=slowest_handler, update_interval=5, background=DARK_NEUTRAL
+        )
+    ]
+    if SHOW_LATENCY
+    else []
+)
+# shared metrics sampler {{{
+SAMPLE_TIMEOUT = 2  # seconds before a blocking source is shown as stale
+SAMPLE_WORKERS = 4
+
+
+class SamplerPool:
+    """Threads running the blocking reads (statvfs of a network mount...)
+
+    Daemon threads, so that one stuck on a dead mount doesn't keep qtile from
+    exiting, started on the first read.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs: queue.SimpleQueue = queue.SimpleQueue()
+        self.threads: list = []
+
+    def submit(self, func):
+        future: Future = Future()
+        self.jobs.put((future, func))
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, name="sampler", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            future, func = self.jobs.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func())
+                except BaseException as error:
+                    future.set_exception(error)
+
+
+# kept across config reloads, its threads can't be stopped
+sampler_pool = globals().get("sampler_pool")
+if not hasattr(sampler_pool, "submit"):  # the class is new after a reload
+    sampler_pool = SamplerPool(SAMPLE_WORKERS)
+
+
+class MetricsSampler:
+    """Reads each metric once per tick and feeds every subscribed graph"""
+
+    def __init__(self):
+        self.sources: dict[tuple, dict] = {}
+        self.scheduled: set[float] = set()
+
+    def subscribe(self, graph):
+        key = graph.source_key()
+        source = self.sources.get(key)
+        if source is None:
+            # blocking sources start empty, their first read is done on the pool
+            value, maxvalue = (0, 0) if graph.blocking else graph.read_sample()
+            source = self.sources[key] = dict(
+                key=key,
+                read=graph.read_sample,
+                ring=SampleRing(graph.samples, value),
+                maxvalue=maxvalue,
+                frequency=graph.frequency,
+                graphs=[],
+                blocking=graph.blocking,
+                pending=None,
+                stale=False,
+            )
+            if graph.blocking:
+                self._read_async(source)
+        source["ring"].resize(graph.samples)
+        source["frequency"] = min(source["frequency"], graph.frequency)
+        source["graphs"].append(graph)
+        graph.attach(source["ring"], source["maxvalue"])
+        self._schedule(source["frequency"])
+
+    def unsubscribe(self, graph):
+        for key, source in list(self.sources.items()):
+            if graph in source["graphs"]:
+                source["graphs"].remove(graph)
+                if not source["graphs"]:
+                    del self.sources[key]
+                elif source["read"] == graph.read_sample:
+                    source["read"] = source["graphs"][0].read_sample
+
+    def _schedule(self, frequency):
+        if frequency not in self.scheduled:
+            self.scheduled.add(frequency)
+            qtile.call_later(frequency, self._tick, frequency)
+
+    def _tick(self, frequency):
+        self.scheduled.discard(frequency)
+        sources = [s for s in self.sources.values() if s["frequency"] == frequency]
+        for source in sources:
+            if source["blocking"]:
+                self._read_async(source)
+                continue
+            try:
+                value, source["maxvalue"] = source["read"]()
+            except OSError:
+                logger.exception("failed to sample %s", source["read"])
+                continue
+            source["ring"].push(value)
+            self._refresh(source)
+        if sources:
+            self._schedule(frequency)
+
+    def _refresh(self, source):
+        for graph in source["graphs"]:
+            graph.refresh(source["maxvalue"], source["stale"])
+
+    def _read_async(self, source):
+        """Sample source on the pool, unless its previous read is still running"""
+        if source["pending"] is not None:
+            return
+        future = source["pending"] = sampler_pool.submit(source["read"])
+        timeout = qtile.call_later(SAMPLE_TIMEOUT, self._timed_out, source, future)
+        future.add_done_callback(
+            lambda f: qtile.call_soon_threadsafe(self._sampled, source, f, timeout)
+        )
+
+    def _timed_out(self, source, future):
+        if source["pending"] is future and not source["stale"]:
+            logger.warning("sampling %s takes over %ss", source["key"], SAMPLE_TIMEOUT)
+            source["stale"] = True
+            self._refresh(source)
+
+    def _sampled(self, source, future, timeout):
+        timeout.cancel()
+        source["pending"] = None
+        try:
+            value, source["maxvalue"] = future.result()
+        except OSError as error:
+            logger.warning("failed to sample %s: %s", source["key"], error)
+            source["stale"] = True
+        else:
+            source["ring"].push(value)
+            source["stale"] = False
+        self._refresh(source)
+
+
+metrics_sampler = MetricsSampler()
+
+
+class SampledGraph(_Graph):
+    """Graph drawing a history kept by the shared metrics sampler"""
+
+    defaults = [
+        ("stale_color", "666666", "Graph color while the last sample timed out"),
+    ]
+    fixed_upper_bound = True
+    blocking = False  # read_sample may block: called on the sampler pool
+    stale = False
+    _ring = None
+    _sampler = None
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.add_defaults(SampledGraph.defaults)
+
+    @property
+    def values(self):
+        return self._ring.latest(self.samples) if self._ring else [0] * self.samples
+
+    @values.setter
+    def values(self, values):
+        pass  # the history lives in the sampler
+
+    def timer_setup(self):
+        # a reload rebinds metrics_sampler before finalizing the old graphs
+        self._sampler = metrics_sampler
+        self._sampler.subscribe(self)
+
+    def finalize(self):
+        if self._sampler is not None:
+            self._sampler.unsubscribe(self)
+            self._sampler = None
+        super().finalize()
+
+    def attach(self, ring, maxvalue):
+        self._ring = ring
+        self.maxvalue = maxvalue
+
+    def refresh(self, maxvalue, stale=False):
+        self.maxvalue = maxvalue
+        self.stale = stale
+        if self.configured and not self.finalized:
+            self.draw()
+
+    def draw(self):
+        if not self.stale:
+            return super().draw()
+        # the last good samples, greyed out
+        colors = self.graph_color, self.fill_color
+        self.graph_color = self.fill_color = self.stale_color
+        try:
+            super().draw()
+        finally:
+            self.graph_color, self.fill_color = colors
+
+    @abc.abstractmethod
+    def source_key(self):
+        """Hashable key shared by the graphs showing the same metric"""
+
+    @abc.abstractmethod
+    def read_sample(self):
+        """Return (value, maxvalue)"""
+
+
+class SharedMemoryGraph(SampledGraph):
+    """MemoryGraph reading /proc/meminfo through the shared sampler"""
+
+    _meminfo_fd = None
+
+    def source_key(self):
+        return ("meminfo",)
+
+    def finalize(self):
+        super().finalize()
+        if self._meminfo_fd is not None:
+            os.close(self._meminfo_fd)
+            self._meminfo_fd = None
+
+    def read_sample(self):
+        if self._meminfo_fd is None:
+            self._meminfo_fd = os.open("/proc/meminfo", os.O_RDONLY)
+        info = {}
+        for line in os.pread(self._meminfo_fd, 8192, 0).splitlines():
+            name, value = line.split(b":", 1)
+            info[name] = int(value.split()[0]) // 1024
+        used = (
+            info[b"MemTotal"]
+            - info[b"MemFree"]
+            - info[b"Buffers"]
+            - info[b"Cached"]
+            - info.get(b"SReclaimable", 0)
+        )
+        return used, info[b"MemTotal"]
+
+
+class SharedHDDGraph(SampledGraph):
+    """HDDGraph whose statvfs calls are shared by all the widgets of a path, and
+    made off the event loop since the path can be a stalled mount"""
+
+    blocking = True
+
+    defaults = [
+        ("path", "/", "Partition mount point."),
+        ("space_type", "used", "free/used"),
+    ]
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.add_defaults(SharedHDDGraph.defaults)
+
+    def source_key(self):
+        return ("statvfs", self.path, self.space_type)
+
+    def read_sample(self):
+        stats = os.statvfs(self.path)
+        if self.space_type == "used":
+            value = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+        else:
+            value = stats.f_bavail * stats.f_frsize
+        return value, stats.f_blocks * stats.f_frsize
+
+
+# }}}
+
 # widgets common styles {{{
 base_widget_style = dict(
     border_width=0,
@@ -570,22 +2604,259 @@ hdd_widgets_style = dict(
     background=DARK_NEUTRAL,
 )
 
-extra_hdd_icon = "🥙 " if (WORK_MODE or gethostname() == "popo") else "🏠 "
+extra_hdd_icon = "🥙 " if (WORK_MODE or HOSTNAME == "popo") else "🏠 "
 extra_hdd_path = (
-    "/stuff"
-    if WORK_MODE
-    else ("/home/fab/grosdisk" if gethostname() == "popo" else "/home")
+    "/stuff" if WORK_MODE else ("/home/fab/grosdisk" if HOSTNAME == "popo" else "/home")
 )
 # }}}
 
 
+# coalesced redraws {{{
+class RedrawScheduler:
+    """Merges the redraw requests of an event loop iteration, per bar
+
+    Widgets are only redrawn when their render_state() changed since they were
+    last drawn, the whole bar only when one of them needs a new length.
+    """
+
+    def __init__(self):
+        self.dirty: dict = {}  # widget -> None, ordered set
+        self.queued = False
+        self.started = time.monotonic()
+        # screen index -> [requests, widget draws, bar draws, skips], not keyed
+        # by bar to keep no reference to the bars gone with a reload or hotplug
+        self.counters: dict = {}
+
+    def request(self, widget):
+        self.dirty[widget] = None
+        self._count(widget.bar, 0)
+        if not self.queued:
+            self.queued = True
+            qtile.call_soon(self.flush)
+
+    def _count(self, bar, field, amount=1):
+        screen = bar.screen.index if bar.screen else None
+        self.counters.setdefault(screen, [0, 0, 0, 0])[field] += amount
+
+    def flush(self):
+        self.queued = False
+        by_bar: dict = {}
+        for widget in self.dirty:
+            if widget.configured and not widget.finalized:
+                by_bar.setdefault(widget.bar, []).append(widget)
+        self.dirty.clear()
+        for bar_, widgets in by_bar.items():
+            changed = [w for w in widgets if w.render_state() != w.drawn_state]
+            self._count(bar_, 3, len(widgets) - len(changed))
+            if any(
+                w.length_type == bar.CALCULATED and w.calculate_length() != w.length
+                for w in changed
+            ):
+                self._count(bar_, 2)
+                bar_.draw()
+            else:
+                self._count(bar_, 1, len(changed))
+                for widget in changed:
+                    widget.draw()
+
+    def report(self):
+        """Per screen rates since startup, eg. for qtile cmd-obj -f eval"""
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            screen: dict(
+                requests_per_s=c[0] / elapsed,
+                widget_draws_per_s=c[1] / elapsed,
+                bar_draws_per_s=c[2] / elapsed,
+                skipped=c[3],
+            )
+            for screen, c in self.counters.items()
+        }
+
+
+redraw_scheduler = RedrawScheduler()
+
+
+class CoalescedDraw:
+    """Mixin routing the hook driven redraws through the redraw scheduler"""
+
+    drawn_state = None
+
+    def render_state(self):
+        return (self.offset, self.length)
+
+    def draw(self):
+        self.drawn_state = self.render_state()
+        super().draw()
+
+
+class CoalescedGroupBox(CoalescedDraw, widget.GroupBox):
+    def render_state(self):
+        return (
+            super().render_state(),
+            self.qtile.current_screen.index,
+            tuple(
+                (
+                    g.name,
+                    g.screen.index if g.screen else None,
+                    bool(g.windows),
+                    self.group_has_urgent(g),
+                )
+                for g in self.groups
+            ),
+        )
+
+    def _hook_response(self, *args, **kwargs):
+        redraw_scheduler.request(self)
+
+
+TITLE_UPDATE_INTERVAL = 0.5  # seconds between two redraws for one window's title
+TITLE_LAYOUT_CACHE = 64  # pango layouts kept per task list
+
+
+class CoalescedTaskList(CoalescedDraw, widget.TaskList):
+    """Task list redrawing a window at most every TITLE_UPDATE_INTERVAL for its
+    title changes, and reusing the pango layouts of the titles it drew recently
+
+    Cache statistics, from a shell:
+    qtile cmd-obj -o widget tasklist -f eval -a "self.layout_cache_stats()"
+    """
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.title_updated: dict[int, float] = {}  # wid -> last accepted change
+        self.title_deferred: set = set()  # wids with a redraw scheduled
+        self.title_throttled = 0
+        self.layouts: dict = {}  # (text, markup, width) -> TextLayout, LRU order
+        self.wm_types: dict[int, str] = {}  # wid -> _NET_WM_WINDOW_TYPE
+        self.layout_hits = 0
+        self.layout_misses = 0
+
+    def _configure(self, qtile, bar):
+        super()._configure(qtile, bar)
+        # drawtext sets self.layout to one of self.layouts
+        self.layout.finalize()
+        self.layout = None
+
+    def setup_hooks(self):
+        hook.subscribe.client_name_updated(self.title_changed)
+        hook.subscribe.focus_change(self.update)
+        hook.subscribe.float_change(self.update)
+        hook.subscribe.client_urgent_hint_changed(self.update)
+        hook.subscribe.net_wm_icon_change(self.invalidate_cache)
+        hook.subscribe.client_killed(self.remove_icon_cache)
+
+    def title_changed(self, window):
+        if window not in self.windows or window.wid in self.title_deferred:
+            return
+        now = time.monotonic()
+        wait = self.title_updated.get(window.wid, 0) + TITLE_UPDATE_INTERVAL - now
+        if wait <= 0:
+            self.title_updated[window.wid] = now
+            self.update(window)
+        else:
+            self.title_throttled += 1
+            self.title_deferred.add(window.wid)
+            self.qtile.call_later(wait, self._deferred_title, window)
+
+    def _deferred_title(self, window):
+        if window.wid in self.title_deferred:
+            self.title_deferred.discard(window.wid)
+            self.title_updated[window.wid] = time.monotonic()
+            self.update(window)
+
+    @property
+    def windows(self):
+        """TaskList.windows without an X round trip per window, the window
+        types being cached: it's called by render_state and each hook"""
+        windows = self.bar.screen.group.windows
+        if self.qtile.core.name != "x11":
+            return windows
+        types = self.wm_types
+        for w in windows:
+            if w.wid not in types:
+                types[w.wid] = w.window.get_wm_type()
+        return [w for w in windows if types[w.wid] in ("normal", None)]
+
+    def remove_icon_cache(self, window):
+        super().remove_icon_cache(window)
+        self.wm_types.pop(window.wid, None)
+        self.title_updated.pop(window.wid, None)
+        self.title_deferred.discard(window.wid)
+
+    def drawtext(self, text, textcolor, width):
+        key = (text, self.markup, width)
+        layout = self.layouts.pop(key, None)
+        if layout is None:
+            self.layout_misses += 1
+            layout = self.drawer.textlayout(
+                "",
+                textcolor,
+                self.font,
+                self.fontsize,
+                self.fontshadow,
+                markup=self.markup,
+                wrap=False,
+            )
+            layout.text = text
+            if width is not None:
+                layout.width = width
+            if len(self.layouts) >= TITLE_LAYOUT_CACHE:
+                self.layouts.pop(next(iter(self.layouts))).finalize()
+        else:
+            self.layout_hits += 1
+        self.layouts[key] = layout
+        layout.colour = textcolor
+        self.layout = layout
+
+    def layout_cache_stats(self):
+        lookups = self.layout_hits + self.layout_misses
+        return dict(
+            hits=self.layout_hits,
+            misses=self.layout_misses,
+            hit_rate=self.layout_hits / lookups if lookups else None,
+            size=len(self.layouts),
+            titles_throttled=self.title_throttled,
+        )
+
+    def finalize(self):
+        for layout in self.layouts.values():
+            layout.finalize()
+        self.layouts.clear()
+        self.layout = None  # finalized above
+        super().finalize()
+
+    def render_state(self):
+        return (
+            super().render_state(),
+            tuple(
+                (w.wid, self.get_taskname(w), w.urgent, id(getattr(w, "icons", None)))
+                for w in self.windows
+            ),
+        )
+
+    def update(self, window=None):
+        if not window or window in self.windows:
+            redraw_scheduler.request(self)
+
+
+class CoalescedCurrentLayoutIcon(CoalescedDraw, widget.CurrentLayoutIcon):
+    def render_state(self):
+        return (super().render_state(), self.current_layout)
+
+    def hook_response(self, layout, group):
+        if group.screen is not None and group.screen == self.bar.screen:
+            self.current_layout = layout.name
+            redraw_scheduler.request(self)
+
+
+# }}}
 # Bar widgets  & screen definition {{{
 def getBasicBarWidgets():
     return [
-        widget.CurrentLayoutIcon(
+        CoalescedCurrentLayoutIcon(
             scale=0.7, background=SECONDARY_COLOR, foreground="#000"
         ),
-        widget.GroupBox(
+        CoalescedGroupBox(
             invert_mouse_wheel=True,
             this_current_screen_border=PRIMARY_COLOR,
             other_current_screen_border=PRIMARY_COLOR,
@@ -605,7 +2876,7 @@ def getBasicBarWidgets():
             center_aligned=True,
         ),
         widget.Prompt(),
-        widget.TaskList(
+        CoalescedTaskList(
             theme_mode="fallback",
             background=DARK_NEUTRAL,
             center_aligned=True,
@@ -622,44 +2893,148 @@ def getBasicBarWidgets():
     ]
 
 
-screens = [
-    Screen(
-        bottom=bar.Bar(
-            getBasicBarWidgets()
-            + [
-                widget.Systray(background=DARK_NEUTRAL),
-            ]
-            + backlight_control
-            + [
-                widget.TextBox(text="🐏", padding=1, background=DARK_NEUTRAL),
-                widget.MemoryGraph(samples=graph_width * 2, **base_widget_style),
-                #         widget.TextBox(text=" ", padding=1),
-                #         widget.NetGraph(samples=graph_width * 6, **gen_widgets_opts),
-                widget.TextBox(text=" ", padding=1, background=DARK_NEUTRAL),
-                widget.HDDGraph(path="/", **hdd_widgets_style),
-                widget.TextBox(text=extra_hdd_icon, padding=1, background=DARK_NEUTRAL),
-                widget.HDDGraph(path=extra_hdd_path, **hdd_widgets_style),
-                widget.Clock(
-                    format="%a %d/%m %H:%M",
-                    background=SECONDARY_COLOR,
-                    foreground="#000",
-                ),
-            ],
-            24,
-            opacity=0.75,
-            margin=[int(MARGIN / 2), MARGIN * 2, int(MARGIN / 2), MARGIN * 2],
-        ),
-    ),
-    Screen(
-        bottom=bar.Bar(
-            getBasicBarWidgets(),
-            24,
-            opacity=0.75,
-            margin=[int(MARGIN / 2), 64, int(MARGIN / 2), 64],
-        ),
-    ),
-]  # }}}
+def getMainBar():
+    """Bar of the primary output, with the systray, graphs and backlight"""
+    return bar.Bar(
+        getBasicBarWidgets()
+        + [
+            widget.Systray(background=DARK_NEUTRAL),
+        ]
+        + latency_control
+        + backlight_control
+        + [
+            widget.TextBox(text="🐏", padding=1, background=DARK_NEUTRAL),
+            SharedMemoryGraph(samples=graph_width * 2, **base_widget_style),
+            #         widget.TextBox(text=" ", padding=1),
+            #         widget.NetGraph(samples=graph_width * 6, **gen_widgets_opts),
+            widget.TextBox(text=" ", padding=1, background=DARK_NEUTRAL),
+            SharedHDDGraph(path="/", **hdd_widgets_style),
+            widget.TextBox(text=extra_hdd_icon, padding=1, background=DARK_NEUTRAL),
+            SharedHDDGraph(path=extra_hdd_path, **hdd_widgets_style),
+        ]
+        + media_control
+        + [
+            widget.Clock(
+                format="%a %d/%m %H:%M",
+                background=SECONDARY_COLOR,
+                foreground="#000",
+            ),
+        ],
+        24,
+        opacity=0.75,
+        margin=[int(MARGIN / 2), MARGIN * 2, int(MARGIN / 2), MARGIN * 2],
+    )
+
+
+def getSecondaryBar():
+    return bar.Bar(
+        getBasicBarWidgets(),
+        24,
+        opacity=0.75,
+        margin=[int(MARGIN / 2), 64, int(MARGIN / 2), 64],
+    )
 
+
+def output_geometries(qtile):
+    """(x, y, width, height) of the outputs, in qtile's screen order"""
+    xywh: dict = {}  # outputs at the same position are aliased, like qtile does
+    for x, y, width, height in qtile.core.get_screen_info():
+        w, h = xywh.get((x, y), (0, 0))
+        xywh[(x, y)] = (max(w, width), max(h, height))
+    return [(x, y, w, h) for (x, y), (w, h) in xywh.items()]
+
+
+def output_layout(qtile):
+    """(number of outputs, index of the RandR primary one, 0 if unknown)"""
+    geometries = output_geometries(qtile)
+    try:
+        conn = qtile.core.conn
+        randr = conn.randr.ext
+        output = randr.GetOutputPrimary(conn.default_screen.root.wid).reply().output
+        crtc = randr.GetOutputInfo(output, 0).reply().crtc if output else 0
+        if crtc:
+            info = randr.GetCrtcInfo(crtc, 0).reply()
+            for i, (x, y, _, _) in enumerate(geometries):
+                if (x, y) == (info.x, info.y):
+                    return len(geometries), i
+    except Exception:  # wayland, no randr
+        logger.debug("no primary output", exc_info=True)
+    return len(geometries), 0
+
+
+class ScreenPool:
+    """Screens created as outputs appear, whose bars outlive the outputs
+
+    The main bar goes to the primary output. The bar of an unplugged output is
+    parked with its widgets, hidden, until an output needs it again.
+    """
+
+    def __init__(self):
+        self.main = None
+        self.others: list = []  # secondary screens, in creation order
+        self.parked: dict = {}  # screen -> its bar, while unused
+
+    def arrange(self, count, primary=0):
+        """The screens of count outputs, the main one at index primary"""
+        if self.main is None:
+            self.main = Screen(bottom=getMainBar())
+        while len(self.others) < count - 1:
+            self.others.append(Screen(bottom=getSecondaryBar()))
+        others = iter(self.others)
+        arranged = [self.main if i == primary else next(others) for i in range(count)]
+        for screen in [self.main] + self.others:
+            if screen in arranged and screen in self.parked:
+                screen.bottom = self.parked.pop(screen)
+            elif screen not in arranged and screen.bottom is not None:
+                # or qtile would finalize the widgets with the bar's window
+                self.parked[screen] = screen.bottom
+                screen.bottom = None
+        return arranged
+
+    def show(self, screens):
+        for screen in screens:
+            if screen.bottom is not None and screen.bottom.window:
+                screen.bottom.window.unhide()
+        for parked in self.parked.values():
+            if parked.window:
+                parked.window.hide()
+
+    def finalize_parked(self):
+        for parked in self.parked.values():
+            parked.finalize()
+        self.parked.clear()
+
+
+_previous_pool = globals().get("screen_pool")
+if _previous_pool is not None and qtile is not None:
+    # after the reload, which only finalizes the bars of the screens in use
+    qtile.call_soon(_previous_pool.finalize_parked)
+screen_pool = ScreenPool()
+# without qtile (check_config, gen_keymap_images), as on the docked laptop
+screens = screen_pool.arrange(*(output_layout(qtile) if qtile else (2, 0)))
+reconfigure_screens = False  # see hotplug_screens
+
+
+@hook.subscribe.screen_change
+def hotplug_screens(event=None):
+    """Give the outputs their pooled screens, without reloading the config"""
+    start = time.perf_counter()
+    count, primary = output_layout(qtile)
+    screens[:] = screen_pool.arrange(count, primary)  # qtile.config.screens
+    qtile.reconfigure_screens()
+    screen_pool.show(qtile.screens)
+    if qtile.current_screen not in qtile.screens:
+        qtile.focus_screen(primary, warp=False)
+    logger.info(
+        "%d screens set up in %.1fms, %d bars parked",
+        count,
+        (time.perf_counter() - start) * 1000,
+        len(screen_pool.parked),
+    )
+
+
+# }}}
+startup_phase("widgets & screens")
 # }}}
 # Drag floating layouts. {{{
 mouse = [
@@ -674,8 +3049,22 @@ mouse = [
     ),
     Click([mod], "Button2", lazy.window.bring_to_front()),
 ]  # }}}
+
+
 # Floating layout {{{
-floating_layout = layout.Floating(
+class IndexedFloating(layout.Floating):
+    """Floating layout checking float rules through a MatchIndex"""
+
+    def __init__(self, float_rules=None, **config):
+        config.setdefault("name", "floating")
+        super().__init__(float_rules, **config)
+        self.float_index = MatchIndex(self.float_rules)
+
+    def match(self, win):
+        return self.float_index.matches_window(win)
+
+
+floating_layout = IndexedFloating(
     border_width=0,
     float_rules=[
         # Run the utility of `xprop` to see the wm class and name of an X client.
@@ -763,65 +3152,475 @@ sticky_windows: list[Match] = [
 
 # }}}
 # Hooks {{{
-@hook.subscribe.client_new
-def new_client_hook(window):
-    # detect background & search for opacity overrides {{{
-    is_background = False
+def fetch_window_props(window):
+    """Read what new_client_hook needs in one X round trip: (props, is_transient)"""
+    xwin = getattr(window, "window", None)
+    if not hasattr(xwin, "conn"):  # not an X11 client
+        props = WindowProps(window.get_wm_class() or (), window.get_wm_type())
+        return props, window.is_transient_for() is not None
+
+    from libqtile.backend.x11.xcbq import WindowTypes
+
+    atoms = xwin.conn.atoms
+    cookies = [
+        xwin.conn.conn.core.GetProperty(
+            False, xwin.wid, atoms[prop], atoms[kind], 0, 2**32 - 1
+        )
+        for prop, kind in (
+            ("WM_TRANSIENT_FOR", "WINDOW"),
+            ("_NET_WM_WINDOW_TYPE", "ATOM"),
+        )
+    ]
+    try:
+        transient, wm_type = [cookie.reply() for cookie in cookies]
+    except Exception:  # window already gone
+        logger.debug("X error reading properties of %s", window.wid)
+        return WindowProps(window.get_wm_class() or ()), False
+    props = WindowProps(window.get_wm_class() or (), wid=window.wid)
+    if wm_type.value_len:
+        name = atoms.get_name(wm_type.value.to_atoms()[0])
+        props.wm_type = WindowTypes.get(name, name)
+    return props, bool(transient.value_len and transient.value.to_atoms()[0])
+
+
+@functools.lru_cache(maxsize=256)
+def client_decision(wm_class, wm_type, is_transient):
+    """Return (opacity, floating, is_background, sticky) for a kind of window
+
+    sticky is None when the sticky rules look at more than the class & type.
+    Check hits & misses with:
+    qtile cmd-obj -o cmd -f eval -a "sys.modules['config'].client_decision.cache_info()"
+    """
+    is_background = "Xfdesktop" in wm_class
     opacity = DEFAULT_OPACITY
-    for cls in window.get_wm_class():
-        if cls == "Xfdesktop":  # or window.window.get_wm_type() == "desktop":
-            is_background = True
+    for cls in wm_class:
         if cls in opacity_exceptions:
             opacity = opacity_overrides.get(cls, 1.0)
+    floating = is_background or is_transient or wm_type in floating_types
+    sticky = None
+    if _sticky_index.depends_only_on("wm_class", "wm_type"):
+        sticky = _sticky_index.matches_window(None, WindowProps(wm_class, wm_type))
+    return opacity, floating, is_background, sticky
 
-    window.opacity = opacity
 
-    if is_background:
-        #         window.fullscreen = True
-        #         window.keep_below()
-        _sticky_windows.add(window)
+_sticky_index = MatchIndex(sticky_windows)
+
+
+@hook.subscribe.client_new
+def new_client_hook(window):
+    props, is_transient = fetch_window_props(window)
+    opacity, floating, is_background, sticky = client_decision(
+        tuple(props.wm_class), props.wm_type, is_transient
+    )
+    if FOCUS_OPACITY and not is_background:
+        _opacity_targets[window.wid] = focus_opacities(tuple(props.wm_class))
+        opacity = _opacity_targets[window.wid][1]
+    window.opacity = opacity
+    if floating:
         window.floating = True
+    if window.wid in _restored_known:
+        sticky = False  # see restore_sticky_windows
+    elif sticky is None:
+        sticky = _sticky_index.matches_window(window)
+    if is_background or sticky:
+        _sticky_windows.add(window)
+    if props.wm_type == "desktop":
+        _desktop_wids.add(window.wid)
+    # windows from a previous instance already have their group
+    if window.group is None:
+        group_name = group_router.value(window, props)
+        if group_name is not None:
+            window.togroup(group_name)
+
+
+# Focus opacity {{{
+_opacity_targets: dict[int, tuple[float, float]] = {}  # wid -> (focused, unfocused)
+_opacity_focused = 0  # wid of the window shown as focused
+
+
+@functools.lru_cache(maxsize=256)
+def focus_opacities(wm_class):
+    """(focused, unfocused) opacity of a window class, exceptions stay fixed"""
+    targets = (FOCUSED_OPACITY, DEFAULT_OPACITY - UNFOCUSED_DIM)
+    for cls in wm_class:
+        if cls in opacity_exceptions:
+            opacity = opacity_overrides.get(cls, 1.0)
+            targets = (opacity, opacity)
+    return targets
+
+
+@hook.subscribe.client_focus
+def update_focus_opacity(window):
+    """Only the windows losing and gaining the focus are changed"""
+    global _opacity_focused
+    previous = _opacity_focused
+    if not FOCUS_OPACITY or previous == window.wid:
+        return
+    if previous in _opacity_targets and previous in qtile.windows_map:
+        qtile.windows_map[previous].opacity = _opacity_targets[previous][1]
+    if window.wid in _opacity_targets:
+        window.opacity = _opacity_targets[window.wid][0]
+    _opacity_focused = window.wid
+
+
+@hook.subscribe.client_managed
+def skip_dropdown_opacity(window):
+    # the dropdowns keep the opacity of their configuration
+    if window.wid in _opacity_targets:
+        for group in qtile.groups:
+            for dropdown in getattr(group, "dropdowns", {}).values():
+                if dropdown.window is window:
+                    del _opacity_targets[window.wid]
+                    return
+
+
+@hook.subscribe.client_killed
+def forget_focus_opacity(window):
+    _opacity_targets.pop(window.wid, None)
+
+
+# }}}
+# Floating windows registry {{{
+# kept across config reloads, which re-execute this file but re-add no window
+_floating_windows: dict[int, Window] = globals().get("_floating_windows", {})
+_desktop_wids: set[int] = globals().get("_desktop_wids", set())
+
+
+def update_floating_registry(window):
+    if window.floating and window.wid not in _desktop_wids and window.group:
+        _floating_windows[window.wid] = window
     else:
-        if (
-            window.window.get_wm_transient_for()
-            or window.window.get_wm_type() in floating_types
-        ):
-            window.floating = True
-    # }}}
-    # auto sticky windows {{{
-    for w in sticky_windows:
-        if w.compare(window):
-            _sticky_windows.add(window)
-    # }}}
+        _floating_windows.pop(window.wid, None)
+
+
+@hook.subscribe.group_window_add
+def track_added_window(group, window):
+    # fired before Group.add applies the float rules
+    qtile.call_soon(update_floating_registry, window)
+
 
+@hook.subscribe.float_change
+def track_float_change():
+    # the windows this file makes floating while unfocused (session restore,
+    # sticky moves) are registered where it does so
+    if qtile.current_window:
+        update_floating_registry(qtile.current_window)
+    for window in list(_floating_windows.values()):
+        update_floating_registry(window)
 
+
+@hook.subscribe.client_killed
+def forget_floating_window(window):
+    _floating_windows.pop(window.wid, None)
+    _desktop_wids.discard(window.wid)
+
+
+# }}}
+# Group occupancy hooks {{{
+@hook.subscribe.group_window_add
+def track_group_occupancy(group, window):
+    group_occupancy.add(window.wid, group.name)
+
+
+@hook.subscribe.client_killed
+def forget_group_occupancy(window):
+    group_occupancy.remove(window.wid)
+
+
+@hook.subscribe.setgroup
+def track_shown_groups():
+    for screen in qtile.screens:
+        group_occupancy.show(screen.index, screen.group and screen.group.name)
+
+
+@hook.subscribe.startup
+def reset_group_occupancy():
+    # fired before qtile gives the windows back their groups on a reload
+    qtile.call_soon(group_occupancy.reset, qtile)
+
+
+# }}}
 # Sticky hooks {{{
-_sticky_windows: set[Window] = set()
+class WindowRegistry:
+    """Windows by id, weakly referenced so that a missed client_killed can't leak"""
+
+    def __init__(self):
+        self._refs: dict[int, weakref.ref] = {}
+
+    def add(self, window):
+        self._refs[window.wid] = weakref.ref(window)
+
+    def discard(self, window):
+        self._refs.pop(window.wid, None)
+
+    def __contains__(self, window):
+        ref = self._refs.get(window.wid)
+        return ref is not None and ref() is window
+
+    def __iter__(self):
+        for wid, ref in list(self._refs.items()):
+            window = ref()
+            if window is None:
+                del self._refs[wid]
+            else:
+                yield window
+
+    def wids(self):
+        return [window.wid for window in self]
+
+
+def state_path(pattern):
+    """Path of a file kept across restarts, in a directory only the user can
+    write to, pattern getting the display"""
+    directory = os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser(
+        "~/.cache/qtile"
+    )
+    return os.path.join(directory, pattern % os.environ.get("DISPLAY", ""))
+
+
+STICKY_STATE = state_path("qtile-sticky%s.json")
+
+
+def load_sticky_state():
+    """Consume the state saved by save_sticky_state: (known wids, sticky wids)"""
+    try:
+        with open(STICKY_STATE) as f:
+            state = json.load(f)
+        os.remove(STICKY_STATE)
+        known, sticky = state["known"], state["sticky"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return set(), set()
+    if not (
+        isinstance(known, list)
+        and isinstance(sticky, list)
+        and all(type(wid) is int for wid in known + sticky)
+    ):
+        logger.warning("ignoring the invalid sticky windows state")
+        return set(), set()
+    return set(known), set(sticky)
+
+
+# the module is re-executed in place by the config reload done on restart,
+# before the restart hook fires: keep the live registry
+_sticky_windows = globals().get("_sticky_windows")
+if not hasattr(_sticky_windows, "wids"):
+    _sticky_windows = WindowRegistry()
+# windows of the previous instance, not matched again when they get re-managed
+_restored_known, _restored_sticky = (
+    load_sticky_state() if qtile is not None else (set(), set())
+)
+
+
+@hook.subscribe.restart
+def save_sticky_state():
+    os.makedirs(os.path.dirname(STICKY_STATE), mode=0o700, exist_ok=True)
+    with open(STICKY_STATE, "w") as f:
+        json.dump(
+            {"known": list(qtile.windows_map), "sticky": _sticky_windows.wids()}, f
+        )
+
+
+@hook.subscribe.startup_complete
+def restore_sticky_windows():
+    for wid in _restored_sticky:
+        window = qtile.windows_map.get(wid)
+        if window is not None:
+            _sticky_windows.add(window)
+    _restored_known.clear()
+    _restored_sticky.clear()
+
+
+def _float_position_on(window, screen):
+    """(x, y) keeping a floating window at its offset from its screen's corner
+    on screen, clamped to fit, None when it is already on that screen"""
+    if screen is None:
+        return None
+    current = qtile.find_closest_screen(window.x, window.y)
+    geometry = (screen.x, screen.y, screen.width, screen.height)
+    if (current.x, current.y, current.width, current.height) == geometry:
+        return None
+    x = min(max(window.x - current.x, 0), max(screen.width - window.width, 0))
+    y = min(max(window.y - current.y, 0), max(screen.height - window.height, 0))
+    return screen.x + x, screen.y + y
 
 
 @hook.subscribe.setgroup
 def move_sticky_windows():
-    for window in _sticky_windows:
-        f = window.floating
-        window.floating = False
-        window.togroup()
-        window.floating = f
+    """Bring the sticky windows to the current group, relayouting once"""
+    start = time.perf_counter()
+    target = qtile.current_group
+    moving = [w for w in _sticky_windows if w.group is not target]
+    if target is None or not moving:
+        return
+    with deferred_layout([target] + [w.group for w in moving]):
+        for window in moving:
+            position = window.floating and _float_position_on(window, target.screen)
+            window.togroup(target.name)
+            if position:
+                window.x, window.y = position
+            update_floating_registry(window)
+    logger.debug(
+        "moved %d sticky windows in %.2fms",
+        len(moving),
+        (time.perf_counter() - start) * 1000,
+    )
 
 
 @hook.subscribe.client_killed
 def remove_sticky_windows(window):
-    if window in _sticky_windows:
-        _sticky_windows.remove(window)
+    _sticky_windows.discard(window)
+
+
+# }}}
+# Session snapshot {{{
+# windows placement saved on restart and re-applied once the windows are back:
+# header, group names, then one record per window
+SESSION_STATE = state_path("qtile-session%s.bin")
+SESSION_HEADER = struct.Struct("<4sHHH")  # magic, version, windows, names size
+# wid, group, floating, float x, y, width, height, opacity, focus rank
+SESSION_RECORD = struct.Struct("<IB?hhHHfH")
+
+
+def save_session_snapshot(qtile):
+    from libqtile.scratchpad import ScratchPad as ScratchPadGroup
+
+    names = [g.name for g in qtile.groups if not isinstance(g, ScratchPadGroup)]
+    records = []
+    for index, name in enumerate(names):
+        group = qtile.groups_map[name]
+        history = group.focus_history
+        for window in group.windows:
+            records.append(
+                SESSION_RECORD.pack(
+                    window.wid,
+                    index,
+                    window.floating,
+                    window.float_x or 0,
+                    window.float_y or 0,
+                    window._float_width,
+                    window._float_height,
+                    window.opacity,
+                    history.index(window) if window in history else 0,
+                )
+            )
+    names_block = "\n".join(names).encode()
+    os.makedirs(os.path.dirname(SESSION_STATE), mode=0o700, exist_ok=True)
+    with open(SESSION_STATE, "wb") as f:
+        f.write(SESSION_HEADER.pack(b"QSNP", 1, len(records), len(names_block)))
+        f.write(names_block)
+        f.write(b"".join(records))
+
+
+def load_session_snapshot():
+    """Consume the snapshot: [(wid, group, floating, geometry, opacity, rank)]"""
+    try:
+        with open(SESSION_STATE, "rb") as f:
+            data = f.read()
+        os.remove(SESSION_STATE)
+        magic, version, count, size = SESSION_HEADER.unpack_from(data)
+        if (magic, version) != (b"QSNP", 1):
+            return []
+        offset = SESSION_HEADER.size
+        names = data[offset : offset + size].decode().split("\n")
+        records = data[offset + size :]
+        if len(records) != count * SESSION_RECORD.size:
+            raise ValueError("%d windows in %d bytes" % (count, len(records)))
+        snapshot = []
+        for (
+            wid,
+            group,
+            floating,
+            x,
+            y,
+            w,
+            h,
+            opacity,
+            rank,
+        ) in SESSION_RECORD.iter_unpack(records):
+            if not 0 <= opacity <= 1:
+                raise ValueError("opacity %r" % opacity)
+            snapshot.append(
+                (wid, names[group], floating, (x, y, w, h), round(opacity, 3), rank)
+            )
+        return snapshot
+    except (OSError, struct.error):
+        return []
+    except (ValueError, IndexError) as e:
+        logger.warning("ignoring the invalid session snapshot: %s", e)
+        return []
+
+
+_session_snapshot = load_session_snapshot() if qtile is not None else []
+_session_restore = contextlib.ExitStack()
+
+
+@hook.subscribe.restart
+def write_session_snapshot():
+    save_session_snapshot(qtile)
+
+
+@hook.subscribe.startup
+def defer_session_layouts():
+    # the existing windows are managed right after this hook
+    if _session_snapshot:
+        _session_restore.enter_context(deferred_layout(qtile.groups))
+
+
+@hook.subscribe.startup_complete
+def apply_session_snapshot():
+    """Put the windows back where they were, relayouting each group once"""
+    if not _session_snapshot:
+        return
+    start = time.perf_counter()
+    ranked: dict = {}
+    with _session_restore:
+        for wid, name, floating, geometry, opacity, rank in _session_snapshot:
+            window = qtile.windows_map.get(wid)
+            group = qtile.groups_map.get(name)
+            if not isinstance(window, Window) or group is None:
+                continue
+            if window.group is not group:
+                window.togroup(name)
+            window.opacity = opacity
+            window.float_x, window.float_y = geometry[:2]
+            window._float_width, window._float_height = geometry[2:]
+            if floating and not window.floating:
+                window.floating = True
+            elif floating and group.screen:
+                x, y, w, h = geometry
+                screen = group.screen
+                window.tweak_float(x=screen.x + x, y=screen.y + y, w=w, h=h)
+            elif not floating and window.floating:
+                window.floating = False
+            update_floating_registry(window)
+            ranked.setdefault(group, []).append((rank, window))
+        for group, windows in ranked.items():
+            windows.sort(key=lambda ranked_window: ranked_window[0])
+            order = [window for _, window in windows if window in group.windows]
+            if not order:
+                continue
+            others = [w for w in group.focus_history if w not in order]
+            group.focus_history[:] = others + order
+            group.focus(order[-1], warp=False)
+    logger.info(
+        "restored %d windows in %.1fms",
+        len(_session_snapshot),
+        (time.perf_counter() - start) * 1000,
+    )
+    _session_snapshot.clear()
 
 
 # }}}
 # {{{ sticky keybind
 @lazy.function
+@timed
 def toggle_sticky_windows(qtile, window=None):  # {{{
     if window is None:
         window = qtile.current_screen.group.current_window
+    if window is None:
+        return
     if window in _sticky_windows:
-        _sticky_windows.remove(window)
+        _sticky_windows.discard(window)
     else:
         _sticky_windows.add(window)
     return window  # }}}
@@ -837,3 +3636,163 @@ keys.append(
 )
 # }}}
 # }}}
+instrument_hooks()
+startup_phase("rules & hooks")
+# Benchmarks {{{
+
+
+def bench_float_rules(count=5000, rounds=5):
+    """Compare the float rule index with qtile's linear scan"""
+    import random
+
+    rules = floating_layout.float_rules
+    index = floating_layout.float_index
+    rnd = random.Random(42)
+    classes = ["kitty", "Brave-browser", "Blender", "Thunar", "Steam", "dialog"]
+    classes += ["wineboot.exe", "control.exe", "gyroflow.py", "Dialo", ""]
+    titles = ["~", "Steam", "SafeEyesss", "Android Emulator - Pixel_5", "Ste"]
+    titles += ["Boot Wine", "pinentry", "Opérations sur les fichiers", None]
+    types = ["normal", "dialog", "utility", "toolbar", "splash", None]
+    classes += ["app-%d" % i for i in range(200)]
+    titles += ["document %d - editor" % i for i in range(200)]
+    types += ["normal"] * 20
+    windows = []
+    for _ in range(count):
+        cls = rnd.choice(classes)
+        windows.append(
+            WindowProps([cls.lower(), cls], rnd.choice(types), rnd.choice(titles))
+        )
+
+    expected = [any(w.match(r) for r in rules) for w in windows]
+    got = [index.matches_window(w) for w in windows]
+    if expected != got:
+        raise RuntimeError("the float rule index and qtile's rules disagree")
+
+    def _bench(func):
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for w in windows:
+                func(w)
+            best = min(best, time.perf_counter() - start)
+        return best * 1e6 / count
+
+    linear = _bench(lambda w: any(w.match(r) for r in rules))
+    indexed = _bench(index.matches_window)
+    print(
+        "%d windows, %d rules, %d floating: list %.2fµs/win, index %.2fµs/win (x%.1f)"
+        % (count, len(rules), sum(got), linear, indexed, linear / indexed)
+    )
+
+
+def bench_layouts(*counts):
+    """Place calls made and skipped by the layouts, per operation, with fake
+    windows on a 1920x1080 screen"""
+    from libqtile.config import ScreenRect
+
+    screen_rect = ScreenRect(0, 24, 1920, 1056)
+
+    class BenchWindow:
+        x = y = width = height = borderwidth = 0
+        bordercolor = None
+        has_focus = False
+        hidden = True
+
+        def __init__(self, wid):
+            self.wid = wid
+
+        def place(self, x, y, width, height, borderwidth, bordercolor, **kwargs):
+            margin = kwargs.get("margin") or 0
+            if isinstance(margin, int):
+                margin = [margin] * 4
+            self.x, self.y = x + margin[3], y + margin[0]
+            self.width = width - margin[1] - margin[3]
+            self.height = height - margin[0] - margin[2]
+            self.borderwidth, self.bordercolor = borderwidth, bordercolor
+
+        def hide(self):
+            self.hidden = True
+
+        def unhide(self):
+            self.hidden = False
+
+        def move_to_top(self):
+            pass
+
+    class BenchGroup:
+        def __init__(self, template, count):
+            self.layout = template.clone(self)
+            self.windows = [BenchWindow(wid) for wid in range(count)]
+            self.current_window = None
+            for window in self.windows:
+                self.layout.add_client(window)
+            self.focus(self.windows[0])
+
+        def focus(self, window, warp=True, force=False):
+            if self.current_window is not None:
+                self.current_window.has_focus = False
+            self.current_window = window
+            if window is not None:
+                window.has_focus = True
+                self.layout.focus(window)
+            self.layout_all()
+
+        def layout_all(self, warp=False):
+            self.layout.layout(self.windows, screen_rect)
+
+    operations = [
+        "next",
+        "grow_right",
+        "grow_left",
+        "flip_left",
+        "shuffle_down",
+        "shuffle_up",
+    ]
+    print("%-8s %5s %-13s %7s %7s %9s" % ("", "", "", "placed", "skipped", "µs/op"))
+    for template in layouts:
+        for count in counts or (10, 100, 500):
+            placements.clear()
+            group = BenchGroup(template, count)
+            for name in operations:
+                operation = getattr(group.layout, name, None)
+                if operation is None:
+                    continue
+                placement_counts[:] = [0, 0]
+                start = time.perf_counter()
+                rounds = 5
+                for _ in range(rounds):
+                    operation()
+                elapsed = (time.perf_counter() - start) / rounds
+                print(
+                    "%-8s %5d %-13s %7.1f %7.1f %9.0f"
+                    % (
+                        template.name,
+                        count,
+                        name,
+                        placement_counts[0] / rounds,
+                        placement_counts[1] / rounds,
+                        elapsed * 1e6,
+                    )
+                )
+    placements.clear()
+
+
+def print_startup_profile():
+    """Per phase breakdown of the time spent importing this file"""
+    total = sum(startup_timings.values())
+    for name, spent in startup_timings.items():
+        print("%-20s %7.1fms %5.1f%%" % (name, spent * 1000, spent * 100 / total))
+    print("%-20s %7.1fms" % ("total", total * 1000))
+
+
+# }}}
+# Entry point (see check_config) {{{
+if __name__ == "__main__":
+    commands = {
+        "bench-float": bench_float_rules,
+        "bench-layouts": bench_layouts,
+        "profile": print_startup_profile,
+    }
+    if len(sys.argv) > 1:
+        commands[sys.argv[1]](*(int(arg) for arg in sys.argv[2:]))
+# }}}